@@ -0,0 +1,23 @@
+from typing import Sequence
+
+from cups.backends.base import Backend
+
+__all__ = [
+    'Backend',
+    'connect',
+]
+
+
+def connect(profile: str, replicas: Sequence[str] = ()) -> Backend:
+    """Create storage backend by profile scheme, Neo4j by default.
+
+    With replica profiles reads are routed to them, see RoutingBackend.
+    """
+    if replicas:
+        from cups.backends.routing import RoutingBackend
+        return RoutingBackend(connect(profile), [connect(i) for i in replicas])
+    if profile.startswith('sqlite:'):
+        from cups.backends.sqlite import SQLiteBackend
+        return SQLiteBackend(profile)
+    from cups.backends.neo4j import Neo4jBackend
+    return Neo4jBackend(profile)
@@ -0,0 +1,193 @@
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, Union
+
+from py2neo import Node
+
+__all__ = [
+    'IS_IN',
+    'IS_IN_AUTO',
+    'ALLOW',
+    'DENY',
+    'INHERITS',
+    'EXISTS_IN',
+    'SUBSET_OF',
+    'SUPPORTS',
+    'ACTIVATED',
+    'ENABLED',
+    'RELATED_TO',
+    'WORKS_IN',
+    'Backend',
+    'ScopeIds',
+    'Session',
+]
+
+IS_IN = 'IS_IN'
+IS_IN_AUTO = 'IS_IN_AUTO'
+ALLOW = 'ALLOW'
+DENY = 'DENY'
+INHERITS = 'INHERITS'
+EXISTS_IN = 'EXISTS_IN'
+SUBSET_OF = 'SUBSET_OF'
+SUPPORTS = 'SUPPORTS'
+ACTIVATED = 'ACTIVATED'
+ENABLED = 'ENABLED'
+RELATED_TO = 'RELATED_TO'
+WORKS_IN = 'ACTIVATED_IN'
+
+# Scope id with all its SUBSET_OF ancestors and the '*' wildcard
+ScopeIds = List[Union[int, str]]
+
+
+class Session:
+    """Causal consistency scope: reads observe every write made through it.
+
+    ``bookmark`` can be carried to another session (e.g. next request of the same user)
+    to keep read-your-writes across them.
+    """
+    __slots__ = ('bookmark', 'pinned', 'written')
+
+    def __init__(self, bookmark: int = None, pinned: bool = False):
+        self.bookmark = bookmark
+        self.pinned = pinned
+        # Whether a transaction wrote anything, None outside of transactions
+        self.written = None  # type: Optional[bool]
+
+
+class Backend:
+    """Storage of the CUPS graph.
+
+    ``label`` arguments are Model labels: colon separated names a node must all carry.
+    ``id=None`` in relationship methods means every node with the given label.
+    Property values set to None are removed.
+    """
+    name: str = None
+    profile: str = None
+
+    def __init__(self, profile: str):
+        self.profile = profile
+        self.listeners = []  # type: List[Callable[[str], None]]
+        self.write_listeners = []  # type: List[Callable[[], None]]
+
+    @property
+    def shareable(self) -> bool:
+        """Whether other processes connecting with the same profile see the same data"""
+        return True
+
+    def notify(self, statement: str) -> None:
+        """Report statement sent to the database to listeners"""
+        for listener in self.listeners:
+            listener(statement)
+
+    def notify_write(self) -> None:
+        """Report that graph data was changed to write listeners"""
+        for listener in self.write_listeners:
+            listener()
+
+    def reconnect(self) -> None:
+        """Drop current connection, e.g. after fork"""
+        raise NotImplementedError
+
+    @contextmanager
+    def session(self, bookmark: int = None) -> Iterator[Session]:
+        """Read-your-writes scope, only meaningful when reads are routed to replicas"""
+        yield Session(bookmark)
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Group operations atomically where the backend supports it"""
+        yield
+
+    @contextmanager
+    def pinned(self) -> Iterator[None]:
+        """Send reads inside the block to the primary database"""
+        yield
+
+    def get_session_bookmark(self) -> Optional[int]:
+        """Bookmark of the current session, None when the backend does not track bookmarks"""
+        return None
+
+    def delete_all(self) -> None:
+        """Delete all nodes and relationships, the bookmark sequence is kept"""
+        raise NotImplementedError
+
+    def get_bookmark(self) -> int:
+        """Return sequence number of the last write recorded with advance_bookmark"""
+        raise NotImplementedError
+
+    def advance_bookmark(self) -> int:
+        """Record a write, return its sequence number"""
+        raise NotImplementedError
+
+    # Nodes
+
+    def match_nodes(self, label: str, id: int = None, props: dict = None, limit: int = None) -> Iterable[Node]:
+        raise NotImplementedError
+
+    def get_node_ids(self, label: str) -> List[int]:
+        """Return ids of all nodes with label in ascending order"""
+        raise NotImplementedError
+
+    def create_node(self, label: str, props: dict) -> int:
+        raise NotImplementedError
+
+    def update_node(self, label: str, id: int, props: dict) -> None:
+        raise NotImplementedError
+
+    def delete_node(self, label: str, id: int) -> None:
+        """Delete node with all its relationships"""
+        raise NotImplementedError
+
+    # Relationships
+
+    def match_related(self, label: str, id: int, types: Sequence[str], target_label: str,
+                      target_id: int = None, props: dict = None) -> Iterable[Tuple[Node, str, dict]]:
+        """Yield (target node, relationship type, relationship properties)"""
+        raise NotImplementedError
+
+    def merge_relationship(self, label: str, id: Optional[int], type: str, target_label: str,
+                           target_id: Optional[int], props: dict = None, set_props: dict = None,
+                           target_props: dict = None, node_props: dict = None) -> None:
+        """Create relationship unless one with props exists, then update it with set_props.
+
+        Targets are optionally filtered by target_props, node_props are set on source nodes.
+        """
+        raise NotImplementedError
+
+    def delete_relationships(self, label: str, id: Optional[int], types: Sequence[str], target_label: str,
+                             target_id: int = None, props: dict = None, node_props: dict = None) -> None:
+        """Delete relationships, node_props are set on source nodes"""
+        raise NotImplementedError
+
+    # Traversal
+
+    def get_reachable_ids(self, label: str, id: int, types: Sequence[str], target_label: str) -> List[int]:
+        """Ids of target_label nodes reachable by one or more relationships of types"""
+        raise NotImplementedError
+
+    def match_reaching(self, label: str, types: Sequence[str], target_label: str, target_id: int) -> Iterable[Node]:
+        """Nodes of label which reach target by one or more relationships of types"""
+        raise NotImplementedError
+
+    def get_scope_support(self, label: str, id: int, scope_label: str,
+                          scope_id: int = None) -> Tuple[Optional[Node], bool]:
+        """Return scope node EXISTS_IN and whether scope_id is that scope or its SUBSET_OF descendant"""
+        raise NotImplementedError
+
+    def match_groups(self, label: str, id: int, group_label: str, scope_label: str,
+                     scope_id: int = None) -> Iterable[Node]:
+        """Groups node IS_IN (excluding auto ones), optionally existing in scope"""
+        raise NotImplementedError
+
+    def get_membership(self, label: str, id: int, group_label: str) -> Tuple[List[Tuple[str, int]], bool]:
+        """Return (IS_IN / IS_IN_AUTO type, group id) pairs and whether node has ALLOW, DENY or ENABLED relationships"""
+        raise NotImplementedError
+
+    def match_allowed_perms(self, label: str, id: int, perm_label: str, scope_label: str,
+                            scope_ids: ScopeIds = None, perm_id: int = None) -> Iterable[Node]:
+        """Perms whose nearest decision from node (or from scopes) is ALLOW"""
+        raise NotImplementedError
+
+    def get_allowed_perm_ids(self, label: str, ids: List[int], perm_label: str, scope_label: str,
+                             scope_ids: ScopeIds = None) -> Dict[int, Set[int]]:
+        """Bulk version of match_allowed_perms keyed by node id"""
+        raise NotImplementedError
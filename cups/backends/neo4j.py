@@ -0,0 +1,271 @@
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+from py2neo import Graph, Node
+from py2neo.cypher import cypher_escape, cypher_repr
+
+from cups.backends.base import *
+from cups.cypher import encode_dict, encode_filter
+
+__all__ = [
+    'Neo4jBackend',
+]
+
+BOOKMARK = 'CupsBookmark'
+
+
+def _where(*conditions: str) -> str:
+    conditions = [i for i in conditions if i]
+    return f'WHERE {" AND ".join(conditions)} ' if conditions else ''
+
+
+def _id_filter(alias: str, id: int = None) -> str:
+    return f'id({alias}) = {id}' if id is not None else ''
+
+
+def _rel(types: Sequence[str], props: dict = None) -> str:
+    return ':' + '|'.join(types) + (f' {encode_dict(props)}' if props else '')
+
+
+def _set(alias: str, props: dict) -> str:
+    return ', '.join([f'{alias}.{cypher_escape(key)} = {cypher_repr(value)}' for key, value in props.items()])
+
+
+class Neo4jBackend(Backend):
+    name = 'neo4j'
+
+    def __init__(self, profile: str):
+        super().__init__(profile)
+        self.graph = Graph(profile)
+        self.local = threading.local()
+        self.bookmark_constraint = False
+
+    def reconnect(self) -> None:
+        self.graph = Graph(self.profile)
+        self.local = threading.local()
+
+    def run(self, cypher: str):
+        self.notify(cypher)
+        return (getattr(self.local, 'tx', None) or self.graph).run(cypher)
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Run statements of the current thread inside the block in one transaction"""
+        if getattr(self.local, 'tx', None) is not None:
+            yield
+            return
+        tx = self.local.tx = self.graph.begin()
+        try:
+            yield
+        except BaseException:
+            self.graph.rollback(tx)
+            raise
+        else:
+            self.graph.commit(tx)
+        finally:
+            self.local.tx = None
+
+    def delete_all(self) -> None:
+        # Bookmark survives so its sequence only grows, replicas still holding
+        # pre-wipe data never look caught up with later sessions
+        self.run(f'MATCH (n) WHERE NOT n:{BOOKMARK} DETACH DELETE n')
+        self.notify_write()
+
+    def get_bookmark(self) -> int:
+        cursor = self.run(f'MATCH (b:{BOOKMARK} {{id: 1}}) RETURN b.seq as i')
+        return max([record['i'] for record in cursor], default=0)
+
+    def advance_bookmark(self) -> int:
+        if not self.bookmark_constraint:
+            # Keeps concurrent MERGE from creating a second bookmark, schema changes
+            # can not share a transaction with data so this runs on its own
+            cypher = f'CREATE CONSTRAINT cups_bookmark IF NOT EXISTS ON (b:{BOOKMARK}) ASSERT b.id IS UNIQUE'
+            self.notify(cypher)
+            self.graph.run(cypher)
+            self.bookmark_constraint = True
+        cursor = self.run(
+            f'MERGE (b:{BOOKMARK} {{id: 1}}) ON CREATE SET b.seq = 0 SET b.seq = b.seq + 1 RETURN b.seq as i')
+        return next(cursor)['i']
+
+    def match_nodes(self, label: str, id: int = None, props: dict = None, limit: int = None) -> Iterable[Node]:
+        cursor = self.run(f'MATCH (i:{label}) {_where(encode_filter(id, **(props or {})))}RETURN i'
+                          + (f' LIMIT {int(limit)}' if limit else ''))
+        for record in cursor:
+            yield record['i']
+
+    def get_node_ids(self, label: str) -> List[int]:
+        return [record['i'] for record in self.run(f'MATCH (i:{label}) RETURN id(i) as i ORDER BY i')]
+
+    def create_node(self, label: str, props: dict) -> int:
+        props = {key: value for key, value in props.items() if value is not None}
+        id = next(self.run(f'CREATE (i:{label} {encode_dict(props)}) RETURN id(i) as i'))['i']
+        self.notify_write()
+        return id
+
+    def update_node(self, label: str, id: int, props: dict) -> None:
+        if props:
+            encode_dict(props)
+            self.run(f'MATCH (i:{label}) WHERE id(i) = {id} SET {_set("i", props)} RETURN i')
+            self.notify_write()
+
+    def delete_node(self, label: str, id: int) -> None:
+        self.run(f'MATCH (i:{label}) WHERE id(i) = {id} DETACH DELETE i')
+        self.notify_write()
+
+    def match_related(self, label: str, id: int, types: Sequence[str], target_label: str,
+                      target_id: int = None, props: dict = None) -> Iterable[Tuple[Node, str, dict]]:
+        cursor = self.run(
+            f'MATCH (i:{label}) -[r{_rel(types, props)}]-> (j:{target_label}) '
+            f'{_where(_id_filter("i", id), _id_filter("j", target_id))}'
+            f'RETURN j, type(r) as t, r')
+        for record in cursor:
+            yield record['j'], record['t'], dict(record['r'])
+
+    def merge_relationship(self, label: str, id: int, type: str, target_label: str,
+                           target_id: int, props: dict = None, set_props: dict = None,
+                           target_props: dict = None, node_props: dict = None) -> None:
+        updates = ([_set('r', set_props)] if set_props else []) + ([_set('i', node_props)] if node_props else [])
+        self.run(
+            f'MATCH (i:{label}) {_where(_id_filter("i", id))}'
+            f'MATCH (j:{target_label}{" " + encode_dict(target_props) if target_props else ""}) '
+            f'{_where(_id_filter("j", target_id))}'
+            f'MERGE (i)-[r{_rel([type], props)}]->(j)'
+            + (f' SET {", ".join(updates)}' if updates else ''))
+        self.notify_write()
+
+    def delete_relationships(self, label: str, id: int, types: Sequence[str], target_label: str,
+                             target_id: int = None, props: dict = None, node_props: dict = None) -> None:
+        if node_props:
+            self.run(
+                f'MATCH (i:{label}) {_where(_id_filter("i", id))}SET {_set("i", node_props)} '
+                f'WITH i OPTIONAL MATCH (i)-[r{_rel(types, props)}]->(j:{target_label}) '
+                f'{_where(_id_filter("j", target_id))}'
+                f'DELETE r')
+        else:
+            self.run(
+                f'MATCH (i:{label})-[r{_rel(types, props)}]->(j:{target_label}) '
+                f'{_where(_id_filter("i", id), _id_filter("j", target_id))}'
+                f'DELETE r')
+        self.notify_write()
+
+    def get_reachable_ids(self, label: str, id: int, types: Sequence[str], target_label: str) -> List[int]:
+        cursor = self.run(
+            f'MATCH (i:{label})-[{_rel(types)}*]->(j:{target_label}) '
+            f'WHERE id(i) = {id} RETURN DISTINCT id(j) as i')
+        return [record['i'] for record in cursor]
+
+    def match_reaching(self, label: str, types: Sequence[str], target_label: str, target_id: int) -> Iterable[Node]:
+        cursor = self.run(
+            f'MATCH (i:{label})-[{_rel(types)}*]->(j:{target_label}) '
+            f'WHERE id(j) = {target_id} RETURN DISTINCT i')
+        for record in cursor:
+            yield record['i']
+
+    def get_scope_support(self, label: str, id: int, scope_label: str,
+                          scope_id: int = None) -> Tuple[Optional[Node], bool]:
+        if scope_id is None:
+            descendant, supported = '', 'false'
+        else:
+            descendant = (
+                f'OPTIONAL MATCH (a)-[:{EXISTS_IN}|{SUBSET_OF}*]->(:{scope_label})<-[:{SUBSET_OF}]-(s:{scope_label}) '
+                f'WHERE id(s) = {scope_id} ')
+            supported = f'id(l) = {scope_id} OR s IS NOT NULL'
+        cursor = self.run(
+            f'MATCH (a:{label}) WHERE id(a) = {id} '
+            f'OPTIONAL MATCH (a)-[:{EXISTS_IN}]->(l:{scope_label}) '
+            f'{descendant}RETURN l, {supported} as k LIMIT 1')
+        record = next(cursor, None)
+        if record is None:
+            return None, False
+        return record['l'], bool(record['k'])
+
+    def match_groups(self, label: str, id: int, group_label: str, scope_label: str,
+                     scope_id: int = None) -> Iterable[Node]:
+        if scope_id is not None:
+            cursor = self.run(
+                f'MATCH (s:{scope_label}) WHERE id(s) = {scope_id} '
+                f'MATCH (e:{label}) -[:{IS_IN}]-> (g:{group_label}) -[:{EXISTS_IN}|{SUBSET_OF}*]-> (s) '
+                f'WHERE NOT (e)-[:{IS_IN_AUTO}]-> (g:{group_label}) AND id(e) = {id} '
+                f'RETURN DISTINCT g'
+            )
+        else:
+            cursor = self.run(
+                f'MATCH (e:{label}) -[:{IS_IN}]-> (g:{group_label}) '
+                f'WHERE NOT (e)-[:{IS_IN_AUTO}]-> (g:{group_label}) AND id(e) = {id} '
+                f'RETURN g'
+            )
+        for record in cursor:
+            yield record['g']
+
+    def get_membership(self, label: str, id: int, group_label: str) -> Tuple[List[Tuple[str, int]], bool]:
+        cursor = self.run(
+            f'MATCH (e:{label}) WHERE id(e) = {id} '
+            f'RETURN [(e)-[r:{IS_IN}|{IS_IN_AUTO}]->(g:{group_label}) | [type(r), id(g)]] as g, '
+            f'exists((e)-[:{ALLOW}|{DENY}|{ENABLED}]->()) as d')
+        record = next(cursor, None)
+        if record is None:
+            return [], False
+        return [(type, group_id) for type, group_id in record['g']], record['d']
+
+    def match_allowed_perms(self, label: str, id: int, perm_label: str, scope_label: str,
+                            scope_ids: ScopeIds = None, perm_id: int = None) -> Iterable[Node]:
+        perm_filter = f'MATCH (p:{perm_label}) WHERE id(p) = {perm_id}' if perm_id is not None else ''
+        target = '(p)' if perm_id is not None else f'(p:{perm_label})'
+        limit = ' LIMIT 1' if perm_id is not None else ''
+        if scope_ids:
+            scope_ids = cypher_repr(scope_ids)
+            cursor = self.run(f"""
+                MATCH (s:{scope_label}) WHERE id(s) IN {scope_ids}
+                CALL {{
+                    MATCH (e:{label}) WHERE id(e) = {id} RETURN e
+                    UNION
+                    WITH s RETURN s as e
+                }}
+                {perm_filter}
+                MATCH r = shortestPath((e)-[*1..16]->{target})
+                WITH relationships(r) as r, tail(reverse(tail(reverse(nodes(r))))) as n, p
+                WHERE type(r[-1]) = "{ALLOW}"
+                    AND (r[-1].scope_id IN {scope_ids} OR NOT EXISTS(r[-1].scope_id))
+                    AND all(i IN n WHERE i.__scope_id__ IN {scope_ids} OR NOT EXISTS(i.__scope_id__))
+                RETURN DISTINCT p{limit}""")
+        else:
+            cursor = self.run(
+                f'MATCH (e:{label}) WHERE id(e) = {id} '
+                f'{perm_filter} '
+                f'MATCH r = shortestPath((e)-[*1..16]->{target}) '
+                f'WITH type(relationships(r)[-1]) = "{ALLOW}" as k, p '
+                f'WHERE k RETURN p{limit}')
+        for record in cursor:
+            yield record['p']
+
+    def get_allowed_perm_ids(self, label: str, ids: List[int], perm_label: str, scope_label: str,
+                             scope_ids: ScopeIds = None) -> Dict[int, Set[int]]:
+        result = {id: set() for id in ids}
+        if not ids:
+            return result
+        if scope_ids:
+            scope_ids = cypher_repr(scope_ids)
+            cursor = self.run(f"""
+                UNWIND {cypher_repr(ids)} as eid
+                MATCH (s:{scope_label}) WHERE id(s) IN {scope_ids}
+                CALL {{
+                    WITH eid MATCH (e:{label}) WHERE id(e) = eid RETURN e
+                    UNION
+                    WITH s RETURN s as e
+                }}
+                MATCH r = shortestPath((e)-[*1..16]->(p:{perm_label}))
+                WITH eid, relationships(r) as r, tail(reverse(tail(reverse(nodes(r))))) as n, p
+                WHERE type(r[-1]) = "{ALLOW}"
+                    AND (r[-1].scope_id IN {scope_ids} OR NOT EXISTS(r[-1].scope_id))
+                    AND all(i IN n WHERE i.__scope_id__ IN {scope_ids} OR NOT EXISTS(i.__scope_id__))
+                RETURN eid as e, collect(DISTINCT id(p)) as p""")
+        else:
+            cursor = self.run(
+                f'MATCH (e:{label}) WHERE id(e) IN {cypher_repr(ids)} '
+                f'MATCH r = shortestPath((e)-[*1..16]->(p:{perm_label})) '
+                f'WITH id(e) as e, type(relationships(r)[-1]) = "{ALLOW}" as k, p '
+                f'WHERE k RETURN e, collect(DISTINCT id(p)) as p')
+        for record in cursor:
+            result[record['e']].update(record['p'])
+        return result
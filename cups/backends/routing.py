@@ -0,0 +1,213 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from itertools import count
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+from py2neo import Node
+
+from cups.backends.base import *
+
+__all__ = [
+    'RoutingBackend',
+    'Session',
+]
+
+
+_session = ContextVar('cups_session', default=None)  # type: ContextVar[Optional[Session]]
+
+
+class RoutingBackend(Backend):
+    """Send writes to primary and reads to replicas which caught up with the session bookmark.
+
+    Every write advances a bookmark sequence stored on primary in the same
+    transaction, so a write is never committed without its bookmark. Replicas
+    are expected to replicate it in order with the rest of data. Reads fall
+    back to primary when no replica has reached the bookmark yet.
+
+    Writes serialize on the bookmark, which is why it is advanced last, right
+    before commit, and once per ``transaction()`` block.
+    """
+
+    def __init__(self, primary: Backend, replicas: Sequence[Backend]):
+        super().__init__(primary.profile)
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.observed = {}  # type: Dict[int, int]
+        self._next = count()
+        for backend in (primary, *self.replicas):
+            backend.listeners = self.listeners
+            backend.write_listeners = self.write_listeners
+
+    @property
+    def name(self) -> str:
+        # Bookmark statements make round trips differ from the bare primary
+        return f'{self.primary.name}+replicas'
+
+    @property
+    def shareable(self) -> bool:
+        return all(backend.shareable for backend in (self.primary, *self.replicas))
+
+    @property
+    def current_session(self) -> Session:
+        session = _session.get()
+        if session is None:
+            session = Session()
+            _session.set(session)
+        return session
+
+    @contextmanager
+    def session(self, bookmark: int = None) -> Iterator[Session]:
+        session = Session(bookmark)
+        token = _session.set(session)
+        try:
+            yield session
+        finally:
+            _session.reset(token)
+
+    @contextmanager
+    def transaction(self) -> Iterator[Session]:
+        """Send every operation inside the block to primary and commit them atomically"""
+        outer = self.current_session
+        if outer.written is not None:
+            yield outer
+            return
+        session = Session(outer.bookmark, pinned=True)
+        session.written = False
+        token = _session.set(session)
+        try:
+            with self.primary.transaction():
+                yield session
+                if session.written:
+                    self._advance(session)
+        finally:
+            _session.reset(token)
+            if session.bookmark is not None:
+                outer.bookmark = max(outer.bookmark or 0, session.bookmark)
+
+    @contextmanager
+    def pinned(self) -> Iterator[None]:
+        outer = self.current_session
+        if outer.pinned:
+            yield
+            return
+        session = Session(outer.bookmark, pinned=True)
+        token = _session.set(session)
+        try:
+            yield
+        finally:
+            _session.reset(token)
+            if session.bookmark is not None:
+                outer.bookmark = max(outer.bookmark or 0, session.bookmark)
+
+    def get_session_bookmark(self) -> Optional[int]:
+        return self.current_session.bookmark or 0
+
+    def reconnect(self) -> None:
+        for backend in (self.primary, *self.replicas):
+            backend.reconnect()
+        self.observed.clear()
+
+    def get_bookmark(self) -> int:
+        return self.primary.get_bookmark()
+
+    def advance_bookmark(self) -> int:
+        return self.primary.advance_bookmark()
+
+    def _reader(self) -> Backend:
+        session = self.current_session
+        if session.pinned or not self.replicas:
+            return self.primary
+        start = next(self._next)
+        for i in range(len(self.replicas)):
+            index = (start + i) % len(self.replicas)
+            replica = self.replicas[index]
+            if session.bookmark is None or self.observed.get(index, 0) >= session.bookmark:
+                return replica
+            self.observed[index] = replica.get_bookmark()
+            if self.observed[index] >= session.bookmark:
+                return replica
+        return self.primary
+
+    def _advance(self, session: Session) -> None:
+        session.bookmark = max(session.bookmark or 0, self.primary.advance_bookmark())
+
+    @contextmanager
+    def _write(self) -> Iterator[None]:
+        """Commit write on primary together with the session bookmark"""
+        session = self.current_session
+        if session.written is not None:
+            yield
+            session.written = True
+            return
+        with self.primary.transaction():
+            yield
+            self._advance(session)
+
+    def delete_all(self) -> None:
+        self.primary.delete_all()
+        self.observed.clear()
+        with self._write():
+            pass
+
+    # Writes
+
+    def create_node(self, label: str, props: dict) -> int:
+        with self._write():
+            return self.primary.create_node(label, props)
+
+    def update_node(self, label: str, id: int, props: dict) -> None:
+        with self._write():
+            self.primary.update_node(label, id, props)
+
+    def delete_node(self, label: str, id: int) -> None:
+        with self._write():
+            self.primary.delete_node(label, id)
+
+    def merge_relationship(self, label: str, id: Optional[int], type: str, target_label: str,
+                           target_id: Optional[int], props: dict = None, set_props: dict = None,
+                           target_props: dict = None, node_props: dict = None) -> None:
+        with self._write():
+            self.primary.merge_relationship(label, id, type, target_label, target_id, props, set_props,
+                                            target_props, node_props)
+
+    def delete_relationships(self, label: str, id: Optional[int], types: Sequence[str], target_label: str,
+                             target_id: int = None, props: dict = None, node_props: dict = None) -> None:
+        with self._write():
+            self.primary.delete_relationships(label, id, types, target_label, target_id, props, node_props)
+
+    # Reads
+
+    def match_nodes(self, label: str, id: int = None, props: dict = None, limit: int = None) -> Iterable[Node]:
+        return self._reader().match_nodes(label, id, props, limit)
+
+    def get_node_ids(self, label: str) -> List[int]:
+        return self._reader().get_node_ids(label)
+
+    def match_related(self, label: str, id: int, types: Sequence[str], target_label: str,
+                      target_id: int = None, props: dict = None) -> Iterable[Tuple[Node, str, dict]]:
+        return self._reader().match_related(label, id, types, target_label, target_id, props)
+
+    def get_reachable_ids(self, label: str, id: int, types: Sequence[str], target_label: str) -> List[int]:
+        return self._reader().get_reachable_ids(label, id, types, target_label)
+
+    def match_reaching(self, label: str, types: Sequence[str], target_label: str, target_id: int) -> Iterable[Node]:
+        return self._reader().match_reaching(label, types, target_label, target_id)
+
+    def get_scope_support(self, label: str, id: int, scope_label: str,
+                          scope_id: int = None) -> Tuple[Optional[Node], bool]:
+        return self._reader().get_scope_support(label, id, scope_label, scope_id)
+
+    def match_groups(self, label: str, id: int, group_label: str, scope_label: str,
+                     scope_id: int = None) -> Iterable[Node]:
+        return self._reader().match_groups(label, id, group_label, scope_label, scope_id)
+
+    def get_membership(self, label: str, id: int, group_label: str) -> Tuple[List[Tuple[str, int]], bool]:
+        return self._reader().get_membership(label, id, group_label)
+
+    def match_allowed_perms(self, label: str, id: int, perm_label: str, scope_label: str,
+                            scope_ids: ScopeIds = None, perm_id: int = None) -> Iterable[Node]:
+        return self._reader().match_allowed_perms(label, id, perm_label, scope_label, scope_ids, perm_id)
+
+    def get_allowed_perm_ids(self, label: str, ids: List[int], perm_label: str, scope_label: str,
+                             scope_ids: ScopeIds = None) -> Dict[int, Set[int]]:
+        return self._reader().get_allowed_perm_ids(label, ids, perm_label, scope_label, scope_ids)
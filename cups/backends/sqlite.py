@@ -0,0 +1,456 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import ujson
+from py2neo import Node
+
+from cups.backends.base import *
+
+__all__ = [
+    'SQLiteBackend',
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (
+    id INTEGER PRIMARY KEY,
+    props TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS labels (
+    label TEXT NOT NULL,
+    node_id INTEGER NOT NULL REFERENCES nodes (id) ON DELETE CASCADE,
+    PRIMARY KEY (label, node_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS labels_node_id ON labels (node_id);
+CREATE TABLE IF NOT EXISTS edges (
+    id INTEGER PRIMARY KEY,
+    src INTEGER NOT NULL REFERENCES nodes (id) ON DELETE CASCADE,
+    dst INTEGER NOT NULL REFERENCES nodes (id) ON DELETE CASCADE,
+    type TEXT NOT NULL,
+    props TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS edges_src_type ON edges (src, type);
+CREATE INDEX IF NOT EXISTS edges_dst_type ON edges (dst, type);
+CREATE TABLE IF NOT EXISTS bookmark (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    seq INTEGER NOT NULL
+);
+"""
+
+MAX_DEPTH = 16
+
+# Keep CTEs referenced several times from being re-evaluated
+MATERIALIZED = 'MATERIALIZED' if sqlite3.sqlite_version_info >= (3, 35) else ''
+
+
+def _check_props(props: dict) -> None:
+    for key, value in props.items():
+        if not isinstance(key, str) or '"' in key:
+            raise ValueError('Invalid property data')
+        if not isinstance(value, (int, float, bool, str)) and value is not None:
+            raise ValueError('Value must be number, bool, str or null')
+
+
+def _has_label(alias: str, label: str) -> Tuple[str, list]:
+    labels = label.split(':')
+    sql = ' AND '.join([f'EXISTS (SELECT 1 FROM labels WHERE node_id = {alias} AND label = ?)'] * len(labels))
+    return sql, labels
+
+
+def _has_props(alias: str, props: dict = None) -> Tuple[str, list]:
+    if not props:
+        return '1', []
+    _check_props(props)
+    sql, params = [], []
+    for key, value in props.items():
+        sql.append(f'json_extract({alias}, ?) = ?')
+        params += [f'$."{key}"', value]
+    return ' AND '.join(sql), params
+
+
+def _has_id(alias: str, id: int = None) -> Tuple[str, list]:
+    if id is None:
+        return '1', []
+    if not isinstance(id, int):
+        raise ValueError('Model ID must be int')
+    return f'{alias} = ?', [id]
+
+
+def _in(values: Sequence) -> str:
+    return ', '.join('?' * len(values))
+
+
+def _dumps(props: dict) -> str:
+    return ujson.dumps({key: value for key, value in props.items() if value is not None})
+
+
+def _node(id: int, props: str, labels: str) -> Node:
+    node = Node(*(labels or '').split(':'), **ujson.loads(props))
+    node.identity = id
+    return node
+
+
+def _scope_ok(value, scope_ids: ScopeIds) -> bool:
+    return value is None or value in scope_ids
+
+
+class SQLiteBackend(Backend):
+    """Embedded storage for single-node deployments.
+
+    Profile follows ``sqlite:///relative/path``, ``sqlite:////absolute/path``
+    or ``sqlite://`` for an in-memory database.
+    """
+    name = 'sqlite'
+
+    def __init__(self, profile: str):
+        super().__init__(profile)
+        path = profile[len('sqlite://'):]
+        if path.startswith('/'):
+            path = path[1:]
+        self.path = path or ':memory:'
+        self.connection = None  # type: sqlite3.Connection
+        # Connection is shared by threads: a transaction holds the lock until it ends,
+        # so statements of other threads never run inside it
+        self.lock = threading.RLock()
+        self.reconnect()
+
+    @property
+    def shareable(self) -> bool:
+        return self.path != ':memory:'
+
+    def reconnect(self) -> None:
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+            self.connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            self.connection.execute('PRAGMA foreign_keys = ON')
+            if self.path != ':memory:':
+                self.connection.execute('PRAGMA journal_mode = WAL')
+            self.connection.executescript(SCHEMA)
+
+    def execute(self, sql: str, params: Sequence = ()) -> sqlite3.Cursor:
+        self.notify(sql)
+        with self.lock:
+            return self.connection.execute(sql, params)
+
+    def executemany(self, sql: str, params: Iterable[Sequence]) -> sqlite3.Cursor:
+        self.notify(sql)
+        with self.lock:
+            return self.connection.executemany(sql, params)
+
+    def query(self, sql: str, params: Sequence = ()) -> List[tuple]:
+        """Execute SELECT and fetch all rows before another thread may use the connection"""
+        self.notify(sql)
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    @contextmanager
+    def transaction(self):
+        """Group statements atomically, transaction control is not reported to listeners"""
+        with self.lock:
+            if self.connection.in_transaction:
+                yield
+                return
+            self.connection.execute('BEGIN')
+            try:
+                yield
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            else:
+                self.connection.execute('COMMIT')
+
+    def delete_all(self) -> None:
+        with self.transaction():
+            self.execute('DELETE FROM edges')
+            self.execute('DELETE FROM labels')
+            self.execute('DELETE FROM nodes')
+        self.notify_write()
+
+    def get_bookmark(self) -> int:
+        rows = self.query('SELECT seq FROM bookmark WHERE id = 1')
+        return rows[0][0] if rows else 0
+
+    def advance_bookmark(self) -> int:
+        with self.transaction():
+            self.execute('INSERT INTO bookmark (id, seq) VALUES (1, 1) ON CONFLICT (id) DO UPDATE SET seq = seq + 1')
+            return self.get_bookmark()
+
+    def _select_nodes(self, where: str, params: list, suffix: str = '') -> Iterable[Node]:
+        rows = self.query(
+            f"SELECT n.id, n.props, (SELECT group_concat(label, ':') FROM labels WHERE node_id = n.id) "
+            f'FROM nodes n WHERE {where} {suffix}', params)
+        for id, props, labels in rows:
+            yield _node(id, props, labels)
+
+    def match_nodes(self, label: str, id: int = None, props: dict = None, limit: int = None) -> Iterable[Node]:
+        label_sql, label_params = _has_label('n.id', label)
+        id_sql, id_params = _has_id('n.id', id)
+        props_sql, props_params = _has_props('n.props', props)
+        yield from self._select_nodes(
+            f'{label_sql} AND {id_sql} AND {props_sql}', label_params + id_params + props_params,
+            f'ORDER BY n.id LIMIT {int(limit)}' if limit else 'ORDER BY n.id')
+
+    def get_node_ids(self, label: str) -> List[int]:
+        label_sql, label_params = _has_label('n.id', label)
+        return [i for i, in self.query(f'SELECT n.id FROM nodes n WHERE {label_sql} ORDER BY n.id', label_params)]
+
+    def create_node(self, label: str, props: dict) -> int:
+        _check_props(props)
+        with self.transaction():
+            id = self.execute('INSERT INTO nodes (props) VALUES (?)', [_dumps(props)]).lastrowid
+            self.executemany('INSERT INTO labels (label, node_id) VALUES (?, ?)',
+                             [(i, id) for i in label.split(':')])
+        self.notify_write()
+        return id
+
+    def update_node(self, label: str, id: int, props: dict) -> None:
+        if not props:
+            return
+        _check_props(props)
+        label_sql, label_params = _has_label('nodes.id', label)
+        self.execute(f'UPDATE nodes SET props = json_patch(props, ?) WHERE nodes.id = ? AND {label_sql}',
+                     [ujson.dumps(props), id] + label_params)
+        self.notify_write()
+
+    def delete_node(self, label: str, id: int) -> None:
+        label_sql, label_params = _has_label('nodes.id', label)
+        self.execute(f'DELETE FROM nodes WHERE nodes.id = ? AND {label_sql}', [id] + label_params)
+        self.notify_write()
+
+    def match_related(self, label: str, id: int, types: Sequence[str], target_label: str,
+                      target_id: int = None, props: dict = None) -> Iterable[Tuple[Node, str, dict]]:
+        label_sql, label_params = _has_label('e.src', label)
+        target_sql, target_params = _has_label('e.dst', target_label)
+        id_sql, id_params = _has_id('e.dst', target_id)
+        props_sql, props_params = _has_props('e.props', props)
+        rows = self.query(
+            f"SELECT n.id, n.props, (SELECT group_concat(label, ':') FROM labels WHERE node_id = n.id), "
+            f'e.type, e.props FROM edges e JOIN nodes n ON n.id = e.dst '
+            f'WHERE e.src = ? AND e.type IN ({_in(types)}) AND {label_sql} AND {target_sql} '
+            f'AND {id_sql} AND {props_sql} ORDER BY e.id',
+            [id, *types] + label_params + target_params + id_params + props_params)
+        for id, props, labels, type, edge_props in rows:
+            yield _node(id, props, labels), type, ujson.loads(edge_props)
+
+    def _node_ids(self, alias: str, label: str, id: int = None, props: dict = None) -> Tuple[str, list]:
+        label_sql, label_params = _has_label(f'{alias}.id', label)
+        id_sql, id_params = _has_id(f'{alias}.id', id)
+        props_sql, props_params = _has_props(f'{alias}.props', props)
+        return (f'SELECT {alias}.id FROM nodes {alias} WHERE {label_sql} AND {id_sql} AND {props_sql}',
+                label_params + id_params + props_params)
+
+    def _update_nodes(self, ids_sql: str, ids_params: list, props: dict) -> None:
+        _check_props(props)
+        self.execute(f'UPDATE nodes SET props = json_patch(props, ?) WHERE id IN ({ids_sql})',
+                     [ujson.dumps(props)] + ids_params)
+
+    def merge_relationship(self, label: str, id: int, type: str, target_label: str,
+                           target_id: int, props: dict = None, set_props: dict = None,
+                           target_props: dict = None, node_props: dict = None) -> None:
+        props, set_props = props or {}, set_props or {}
+        _check_props(set_props)
+        sources_sql, sources_params = self._node_ids('s', label, id)
+        targets_sql, targets_params = self._node_ids('t', target_label, target_id, target_props)
+        props_sql, props_params = _has_props('e.props', props)
+        with self.transaction():
+            self.execute(
+                f'INSERT INTO edges (src, dst, type, props) '
+                f'SELECT s.id, t.id, ?, ? FROM ({sources_sql}) s, ({targets_sql}) t '
+                f'WHERE NOT EXISTS (SELECT 1 FROM edges e WHERE e.src = s.id AND e.dst = t.id '
+                f'AND e.type = ? AND {props_sql})',
+                [type, _dumps({**props, **set_props})] + sources_params + targets_params + [type] + props_params)
+            if set_props:
+                props_sql, props_params = _has_props('props', props)
+                self.execute(
+                    f'UPDATE edges SET props = json_patch(props, ?) '
+                    f'WHERE type = ? AND src IN ({sources_sql}) AND dst IN ({targets_sql}) AND {props_sql}',
+                    [ujson.dumps(set_props), type] + sources_params + targets_params + props_params)
+            if node_props:
+                self._update_nodes(sources_sql, sources_params, node_props)
+        self.notify_write()
+
+    def delete_relationships(self, label: str, id: int, types: Sequence[str], target_label: str,
+                             target_id: int = None, props: dict = None, node_props: dict = None) -> None:
+        sources_sql, sources_params = self._node_ids('s', label, id)
+        targets_sql, targets_params = self._node_ids('t', target_label, target_id)
+        props_sql, props_params = _has_props('props', props)
+        with self.transaction():
+            self.execute(
+                f'DELETE FROM edges WHERE type IN ({_in(types)}) AND {props_sql} '
+                f'AND src IN ({sources_sql}) AND dst IN ({targets_sql})',
+                [*types] + props_params + sources_params + targets_params)
+            if node_props:
+                self._update_nodes(sources_sql, sources_params, node_props)
+        self.notify_write()
+
+    def _reach_sql(self, types: Sequence[str], forward: bool = True) -> Tuple[str, list]:
+        """Recursive CTE ``reach(node)`` seeded by a single ``?`` node id"""
+        near, far = ('src', 'dst') if forward else ('dst', 'src')
+        return (
+            f'reach(node) AS ('
+            f'SELECT {far} FROM edges WHERE {near} = ? AND type IN ({_in(types)}) '
+            f'UNION '
+            f'SELECT e.{far} FROM reach r JOIN edges e ON e.{near} = r.node WHERE e.type IN ({_in(types)}))',
+            [*types, *types],
+        )
+
+    def get_reachable_ids(self, label: str, id: int, types: Sequence[str], target_label: str) -> List[int]:
+        reach_sql, reach_params = self._reach_sql(types)
+        start_sql, start_params = self._node_ids('s', label, id)
+        target_sql, target_params = _has_label('r.node', target_label)
+        rows = self.query(
+            f'WITH RECURSIVE {reach_sql} SELECT r.node FROM reach r '
+            f'WHERE EXISTS ({start_sql}) AND {target_sql} ORDER BY r.node',
+            [id] + reach_params + start_params + target_params)
+        return [i for i, in rows]
+
+    def match_reaching(self, label: str, types: Sequence[str], target_label: str, target_id: int) -> Iterable[Node]:
+        reach_sql, reach_params = self._reach_sql(types, forward=False)
+        target_sql, target_params = self._node_ids('t', target_label, target_id)
+        label_sql, label_params = _has_label('n.id', label)
+        yield from self._select_nodes(
+            f'n.id IN (WITH RECURSIVE {reach_sql} SELECT node FROM reach) '
+            f'AND EXISTS ({target_sql}) AND {label_sql}',
+            [target_id] + reach_params + target_params + label_params, 'ORDER BY n.id')
+
+    def get_scope_support(self, label: str, id: int, scope_label: str,
+                          scope_id: int = None) -> Tuple[Optional[Node], bool]:
+        reach_sql, reach_params = self._reach_sql([EXISTS_IN, SUBSET_OF])
+        start_sql, start_params = self._node_ids('a', label, id)
+        local_sql, local_params = _has_label('n.id', scope_label)
+        parent_sql, parent_params = _has_label('r.node', scope_label)
+        scope_sql, scope_params = _has_label('e.src', scope_label)
+        rows = self.query(
+            f'WITH RECURSIVE {reach_sql} '
+            f"SELECT n.id, n.props, (SELECT group_concat(label, ':') FROM labels WHERE node_id = n.id), "
+            f'n.id = ? OR EXISTS (SELECT 1 FROM reach r JOIN edges e ON e.dst = r.node '
+            f'WHERE e.src = ? AND e.type = ? AND {parent_sql} AND {scope_sql}) '
+            f'FROM edges x JOIN nodes n ON n.id = x.dst '
+            f'WHERE x.src = ? AND x.type = ? AND {local_sql} AND EXISTS ({start_sql}) ORDER BY x.id LIMIT 1',
+            [id] + reach_params + [scope_id, scope_id, SUBSET_OF] + parent_params + scope_params
+            + [id, EXISTS_IN] + local_params + start_params)
+        if not rows:
+            return None, False
+        local_id, props, labels, supported = rows[0]
+        return _node(local_id, props, labels), bool(supported)
+
+    def match_groups(self, label: str, id: int, group_label: str, scope_label: str,
+                     scope_id: int = None) -> Iterable[Node]:
+        label_sql, label_params = _has_label('e.src', label)
+        group_sql, group_params = _has_label('e.dst', group_label)
+        groups_sql = (
+            f'SELECT e.dst FROM edges e WHERE e.src = ? AND e.type = ? AND {label_sql} AND {group_sql} '
+            f'AND NOT EXISTS (SELECT 1 FROM edges a WHERE a.src = e.src AND a.dst = e.dst AND a.type = ?)')
+        groups_params = [id, IS_IN] + label_params + group_params + [IS_IN_AUTO]
+        if scope_id is None:
+            yield from self._select_nodes(f'n.id IN ({groups_sql})', groups_params, 'ORDER BY n.id')
+            return
+        types = [EXISTS_IN, SUBSET_OF]
+        scope_sql, scope_params = _has_label('r.node', scope_label)
+        yield from self._select_nodes(
+            f'n.id IN (WITH RECURSIVE reach(g, node) AS ('
+            f'SELECT e.src, e.dst FROM edges e WHERE e.src IN ({groups_sql}) AND e.type IN ({_in(types)}) '
+            f'UNION '
+            f'SELECT r.g, e.dst FROM reach r JOIN edges e ON e.src = r.node WHERE e.type IN ({_in(types)})) '
+            f'SELECT r.g FROM reach r WHERE r.node = ? AND {scope_sql})',
+            groups_params + types + types + [scope_id] + scope_params, 'ORDER BY n.id')
+
+    def get_membership(self, label: str, id: int, group_label: str) -> Tuple[List[Tuple[str, int]], bool]:
+        label_sql, label_params = _has_label('e.src', label)
+        group_sql, group_params = _has_label('e.dst', group_label)
+        direct = [ALLOW, DENY, ENABLED]
+        rows = self.query(
+            f'SELECT e.type, e.dst FROM edges e WHERE e.src = ? AND {label_sql} '
+            f'AND (e.type IN (?, ?) AND {group_sql} OR e.type IN ({_in(direct)})) ORDER BY e.id',
+            [id] + label_params + [IS_IN, IS_IN_AUTO] + group_params + direct)
+        groups, has_direct = [], False
+        for type, group_id in rows:
+            if type in direct:
+                has_direct = True
+            else:
+                groups.append((type, group_id))
+        return groups, has_direct
+
+    def _decide(self, label: str, ids: List[int], perm_label: str, scope_label: str,
+                scope_ids: ScopeIds = None, perm_id: int = None) -> Dict[int, Dict[int, Node]]:
+        """Resolve nearest ALLOW/DENY decisions of nodes, return {node id: {perm id: perm}}.
+
+        Like Neo4j ``shortestPath`` the nearest path to a perm is found over all
+        relationships first, then checked to end with ALLOW; ties resolve to DENY.
+        With scope_ids every scope is traversed as well and grants its perms to all
+        nodes, while paths must stay within scopes.
+        """
+        result = {id: {} for id in ids}
+        if not ids:
+            return result
+        label_sql, label_params = _has_label('n.id', label)
+        start_sql = f'SELECT n.id FROM nodes n WHERE n.id IN ({_in(ids)}) AND {label_sql}'
+        start_params = ids + label_params
+        if scope_ids:
+            scopes = [i for i in scope_ids if isinstance(i, int)]
+            scope_sql, scope_params = _has_label('n.id', scope_label)
+            start_sql += f' UNION SELECT n.id FROM nodes n WHERE n.id IN ({_in(scopes)}) AND {scope_sql}'
+            start_params += scopes + scope_params
+            node_ok = (f"(json_extract(n.props, '$.__scope_id__') IS NULL "
+                       f"OR json_extract(n.props, '$.__scope_id__') IN ({_in(scope_ids)}))")
+            node_ok_params = list(scope_ids)
+        else:
+            node_ok, node_ok_params = '1', []
+        perm_sql, perm_params = _has_label('dp.node', perm_label)
+        id_sql, id_params = _has_id('dp.node', perm_id)
+        rows = self.query(
+            f'WITH RECURSIVE '
+            f'start(root) AS ({start_sql}), '
+            f'reach(root, node, depth) AS ('
+            f'SELECT root, root, 0 FROM start '
+            f'UNION '
+            f'SELECT r.root, e.dst, r.depth + 1 FROM reach r JOIN edges e ON e.src = r.node '
+            f'WHERE r.depth < {MAX_DEPTH}), '
+            f'dist(root, node, depth) AS {MATERIALIZED} ('
+            f'SELECT root, node, MIN(depth) FROM reach GROUP BY root, node), '
+            f'valid(root, node) AS ('
+            f'SELECT root, root FROM start '
+            f'UNION '
+            f'SELECT v.root, e.dst FROM valid v '
+            f'JOIN dist dv ON dv.root = v.root AND dv.node = v.node '
+            f'JOIN edges e ON e.src = v.node '
+            f'JOIN dist dy ON dy.root = v.root AND dy.node = e.dst AND dy.depth = dv.depth + 1 '
+            f'JOIN nodes n ON n.id = e.dst WHERE {node_ok}) '
+            f"SELECT dp.root, dp.node, p.props, (SELECT group_concat(label, ':') FROM labels WHERE node_id = p.id), "
+            f"e.type, json_extract(e.props, '$.scope_id'), v.node IS NOT NULL "
+            f'FROM dist dp '
+            f'JOIN nodes p ON p.id = dp.node '
+            f'JOIN edges e ON e.dst = dp.node '
+            f'JOIN dist dx ON dx.root = dp.root AND dx.node = e.src AND dx.depth = dp.depth - 1 '
+            f'LEFT JOIN valid v ON v.root = dp.root AND v.node = e.src '
+            f'WHERE dp.depth > 0 AND {perm_sql} AND {id_sql}',
+            start_params + node_ok_params + perm_params + id_params)
+        decisions = {}  # type: Dict[Tuple[int, int], bool]
+        perms = {}  # type: Dict[int, Node]
+        for root, perm, props, labels, type, scope_id, valid in rows:
+            key = (root, perm)
+            perms.setdefault(perm, _node(perm, props, labels))
+            if type != ALLOW:
+                decisions[key] = False
+            elif decisions.get(key) is not False:
+                allowed = not scope_ids or (valid and _scope_ok(scope_id, scope_ids))
+                decisions[key] = decisions.get(key) or allowed
+        shared = {}
+        for (root, perm), allowed in decisions.items():
+            if allowed:
+                result.get(root, shared)[perm] = perms[perm]
+        for allowed in result.values():
+            allowed.update(shared)
+        return result
+
+    def get_allowed_perm_ids(self, label: str, ids: List[int], perm_label: str, scope_label: str,
+                             scope_ids: ScopeIds = None) -> Dict[int, Set[int]]:
+        return {id: set(perms) for id, perms in self._decide(label, ids, perm_label, scope_label, scope_ids).items()}
+
+    def match_allowed_perms(self, label: str, id: int, perm_label: str, scope_label: str,
+                            scope_ids: ScopeIds = None, perm_id: int = None) -> Iterable[Node]:
+        perms = self._decide(label, [id], perm_label, scope_label, scope_ids, perm_id)[id]
+        for perm in sorted(perms):
+            yield perms[perm]
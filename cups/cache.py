@@ -0,0 +1,148 @@
+"""Permission decisions shared by entities with the same group membership.
+
+An entity without its own ALLOW, DENY or ENABLED relationships reaches perms
+only through its groups, so its decisions equal those of any other such entity
+in the same groups. Entity methods keep cached memberships up to date, any
+other write through ``cups.db.graph`` drops the whole cache.
+
+The cache is off by default. It lives in process memory, so writes made by
+other processes are seen only after ``CUPS_DECISION_CACHE_TTL`` seconds; enable
+it only where that delay is acceptable. Entries are filled from the primary
+database and skipped by sessions holding a newer bookmark. Each of memberships
+and decisions keeps at most ``CUPS_DECISION_CACHE_SIZE`` least recently used entries.
+"""
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import monotonic
+from typing import Callable, FrozenSet, Hashable, Iterator, NamedTuple, Optional, Tuple
+
+from py2neo import Node
+
+from cups.db import graph
+
+__all__ = [
+    'Membership',
+    'DecisionCache',
+    'decision_cache',
+]
+
+
+class Membership(NamedTuple):
+    groups: FrozenSet[int]
+    auto_groups: FrozenSet[int]
+    direct: bool
+
+    @property
+    def signature(self) -> Optional[FrozenSet[int]]:
+        """Groups entity reaches perms through, None when it has decisions of its own"""
+        return None if self.direct else self.groups | self.auto_groups
+
+
+class _Entry(NamedTuple):
+    time: float
+    # Primary bookmark when entry was read, None when bookmarks are not tracked
+    stamp: Optional[int]
+    value: object
+
+
+_local_write = ContextVar('cups_local_write', default=False)  # type: ContextVar[bool]
+
+
+class DecisionCache:
+    def __init__(self, ttl: float, size: int = 10000):
+        self.ttl = ttl
+        self.size = size
+        self.generation = 0
+        # Shared by threads: lookups, eviction and clearing must not interleave
+        self.lock = threading.Lock()
+        self.memberships = OrderedDict()  # type: OrderedDict[int, _Entry]
+        self.decisions = OrderedDict()  # type: OrderedDict[Hashable, _Entry]
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def _get(self, store: OrderedDict, key: Hashable, bookmark: int = None):
+        with self.lock:
+            entry = store.get(key)
+            if entry is None:
+                return None
+            if monotonic() - entry.time > self.ttl:
+                del store[key]
+                return None
+            if bookmark is not None and (entry.stamp is None or bookmark > entry.stamp):
+                return None
+            store.move_to_end(key)
+            return entry.value
+
+    def _set(self, store: OrderedDict, key: Hashable, value, generation: int, stamp: int = None):
+        """Store value unless cache was cleared since generation was read"""
+        with self.lock:
+            if self.enabled and generation == self.generation:
+                store[key] = _Entry(monotonic(), stamp, value)
+                store.move_to_end(key)
+                while len(store) > self.size:
+                    store.popitem(last=False)
+        return value
+
+    def get_membership(self, id: int, bookmark: int = None) -> Optional[Membership]:
+        return self._get(self.memberships, id, bookmark)
+
+    def set_membership(self, id: int, membership: Membership, generation: int, stamp: int = None) -> Membership:
+        return self._set(self.memberships, id, membership, generation, stamp)
+
+    def get_decision(self, key: Hashable, bookmark: int = None) -> Optional[Tuple[Node, ...]]:
+        return self._get(self.decisions, key, bookmark)
+
+    def set_decision(self, key: Hashable, perms: Tuple[Node, ...], generation: int,
+                     stamp: int = None) -> Tuple[Node, ...]:
+        return self._set(self.decisions, key, perms, generation, stamp)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.generation += 1
+            self.memberships.clear()
+            self.decisions.clear()
+
+    def on_write(self) -> None:
+        if not _local_write.get():
+            self.clear()
+
+    @contextmanager
+    def local_write(self, id: int, update: Callable[[Membership], Membership] = None) -> Iterator[None]:
+        """Writes inside only touch relationships of entity id.
+
+        Shared decisions are kept, the cached membership of the entity is passed
+        through update or dropped when update is not given.
+        """
+        with self.lock:
+            entry = self.memberships.get(id)
+            if entry is not None and monotonic() - entry.time > self.ttl:
+                entry = None
+            generation = self.generation
+        token = _local_write.set(True)
+        try:
+            yield
+        except BaseException:
+            with self.lock:
+                self.memberships.pop(id, None)
+            raise
+        finally:
+            _local_write.reset(token)
+        with self.lock:
+            if entry is not None and update is not None:
+                if generation == self.generation:
+                    # Age is kept: the update does not refresh what other processes may have changed
+                    self.memberships[id] = entry._replace(value=update(entry.value))
+            else:
+                self.memberships.pop(id, None)
+
+
+decision_cache = DecisionCache(
+    float(os.environ.get('CUPS_DECISION_CACHE_TTL', 0)),
+    int(os.environ.get('CUPS_DECISION_CACHE_SIZE', 10000)),
+)
+graph.write_listeners.append(decision_cache.on_write)
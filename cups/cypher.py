@@ -0,0 +1,32 @@
+from py2neo.cypher import cypher_escape, cypher_repr
+
+__all__ = [
+    'encode_dict',
+    'encode_filter',
+]
+
+
+def encode_dict(obj: dict) -> str:
+    for key, value in obj.items():
+        if not isinstance(key, str):
+            raise ValueError('Key must be str')
+        elif not isinstance(value, (int, float, bool, str)) and value is not None:
+            raise ValueError('Value must be number, bool, str or null')
+    return cypher_repr(obj)
+
+
+def encode_filter(id: int = None, /, **kwargs) -> str:
+    f = []
+    if id is not None:
+        if not isinstance(id, int):
+            raise ValueError('Model ID must be int')
+        f.append(f'id(i) = {id}')
+    if kwargs:
+        for key, value in kwargs.items():
+            if not isinstance(value, (int, float, bool, str)) and value is not None:
+                raise ValueError('Invalid property data type')
+            try:
+                f.append(f'i.{cypher_escape(key)} = {cypher_repr(value)}')
+            except ValueError:
+                raise ValueError('Invalid property data')
+    return ' AND '.join(f)
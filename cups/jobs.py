@@ -0,0 +1,209 @@
+"""Audit allowed perms of every entity in every scope with a pool of worker processes.
+
+Entities are split into id ranges, one partition per range and scope, each
+resolved by a single bulk query in a worker with its own connection. Rows
+``(entity id, scope id, allowed perm ids)`` stream to a JSON lines or CSV file
+as partitions finish::
+
+    from cups.jobs import audit
+
+    audit('audit.jsonl', concurrency=4, checkpoint='audit.checkpoint')
+
+Ids of finished partitions are appended to the checkpoint, a rerun with the
+same checkpoint skips them and appends to the output, which is otherwise
+overwritten. A partition interrupted after its rows were written but before
+the checkpoint was updated is written again.
+
+Command line: ``python -m cups.jobs audit.csv --concurrency 4 --checkpoint audit.checkpoint``
+"""
+import csv
+import os
+from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Callable, Dict, IO, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple, Type
+
+import ujson
+
+from cups.backends.base import ScopeIds
+from cups.db import graph
+from cups.models import Entity, Perm, Scope, _get_scope_ids
+
+__all__ = [
+    'Partition',
+    'Checkpoint',
+    'JsonLinesSink',
+    'CsvSink',
+    'open_sink',
+    'plan_partitions',
+    'audit',
+]
+
+Row = Tuple[int, Optional[int], List[int]]
+
+
+class Partition(NamedTuple):
+    scope_id: Optional[int]
+    scope_ids: Optional[ScopeIds]
+    ids: Tuple[int, ...]
+
+
+class Checkpoint:
+    """Entity ids already audited per scope, kept in a JSON lines file.
+
+    Exact ids are stored rather than ranges, so entities created later with ids
+    between audited ones (Neo4j reuses ids of deleted nodes) are not skipped.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done = {}  # type: Dict[Optional[int], Set[int]]
+        if os.path.exists(path):
+            with open(path) as fh:
+                for line in fh:
+                    try:
+                        item = ujson.loads(line)
+                    except ValueError:  # torn last line of an interrupted run
+                        continue
+                    self.done.setdefault(item['scope'], set()).update(item['ids'])
+
+    def is_done(self, scope_id: Optional[int], id: int) -> bool:
+        return id in self.done.get(scope_id, ())
+
+    def add(self, partition: Partition) -> None:
+        self.done.setdefault(partition.scope_id, set()).update(partition.ids)
+        with open(self.path, 'a') as fh:
+            fh.write(ujson.dumps({'scope': partition.scope_id, 'ids': list(partition.ids)}))
+            fh.write('\n')
+
+
+class JsonLinesSink:
+    def __init__(self, fh: IO[str]):
+        self.fh = fh
+
+    def write(self, rows: Iterable[Row]) -> None:
+        for entity_id, scope_id, perm_ids in rows:
+            self.fh.write(ujson.dumps({'entity': entity_id, 'scope': scope_id, 'perms': perm_ids}))
+            self.fh.write('\n')
+        self.fh.flush()
+
+
+class CsvSink:
+    """Columns entity, scope (empty for unscoped), perms (space separated ids)"""
+
+    def __init__(self, fh: IO[str]):
+        self.fh = fh
+        self.writer = csv.writer(fh)
+        if fh.tell() == 0:
+            self.writer.writerow(['entity', 'scope', 'perms'])
+
+    def write(self, rows: Iterable[Row]) -> None:
+        for entity_id, scope_id, perm_ids in rows:
+            self.writer.writerow([entity_id, '' if scope_id is None else scope_id, ' '.join(map(str, perm_ids))])
+        self.fh.flush()
+
+
+def open_sink(fh: IO[str]):
+    """CSV sink for ``.csv`` files, JSON lines otherwise"""
+    if getattr(fh, 'name', '').endswith('.csv'):
+        return CsvSink(fh)
+    return JsonLinesSink(fh)
+
+
+def plan_partitions(model: Type[Entity] = Entity, scopes: Iterable[Optional[Scope]] = None, size: int = 500,
+                    checkpoint: Checkpoint = None) -> List[Partition]:
+    """Split entities not yet in checkpoint into chunks of size ids for each scope.
+
+    All scopes and no scope (None) are audited by default.
+    """
+    if scopes is None:
+        scopes = [None, *Scope.get_all()]
+    ids = graph.get_node_ids(model.label)
+    partitions = []
+    for scope in scopes:
+        scope_id = scope.id if scope else None
+        scope_ids = _get_scope_ids(scope) if scope else None
+        pending = [i for i in ids if not (checkpoint and checkpoint.is_done(scope_id, i))]
+        for offset in range(0, len(pending), size):
+            partitions.append(Partition(scope_id, scope_ids, tuple(pending[offset:offset + size])))
+    return partitions
+
+
+def _init_worker() -> None:
+    # Connection inherited from a forked parent must not be shared
+    graph.reconnect()
+
+
+def _audit_partition(label: str, partition: Partition) -> Tuple[Partition, List[Row]]:
+    allowed = graph.get_allowed_perm_ids(label, list(partition.ids), Perm.label, Scope.label, partition.scope_ids)
+    return partition, [(id, partition.scope_id, sorted(allowed[id])) for id in partition.ids]
+
+
+def _run_pool(label: str, partitions: List[Partition], concurrency: int) -> Iterator[Tuple[Partition, List[Row]]]:
+    """Yield results as they finish, keeping at most two partitions per worker queued"""
+    queue = iter(partitions)
+    pending = set()  # type: Set[Future]
+    with ProcessPoolExecutor(concurrency, initializer=_init_worker) as pool:
+        while True:
+            while len(pending) < concurrency * 2 and (partition := next(queue, None)) is not None:
+                pending.add(pool.submit(_audit_partition, label, partition))
+            if not pending:
+                return
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def audit(path: str, model: Type[Entity] = Entity, scopes: Iterable[Optional[Scope]] = None,
+          concurrency: int = None, partition_size: int = 500, checkpoint: str = None,
+          progress: Callable[[int, int], None] = None) -> int:
+    """Write allowed perms of every entity in every scope to path, return number of rows written.
+
+    ``concurrency`` limits worker processes (and so parallel queries), defaults
+    to CPU count; 0 runs in the current process. A database workers can not
+    open (in-memory SQLite) runs in the current process by default and raises
+    ValueError with explicit concurrency. ``progress(done, total)`` is called
+    with row counts after every partition.
+    """
+    if concurrency is None:
+        concurrency = (os.cpu_count() or 1) if graph.shareable else 0
+    elif concurrency and not graph.shareable:
+        raise ValueError(f'Worker processes can not share database {graph.profile}, use concurrency=0')
+    state = Checkpoint(checkpoint) if checkpoint else None
+    partitions = plan_partitions(model, scopes, partition_size, state)
+    total = sum(len(partition.ids) for partition in partitions)
+    if concurrency:
+        results = _run_pool(model.label, partitions, concurrency)
+    else:
+        results = (_audit_partition(model.label, partition) for partition in partitions)
+    written = 0
+    # Output of a previous run is kept only when resuming its finished partitions
+    with open(path, 'a' if state and state.done else 'w', newline='') as fh:
+        sink = open_sink(fh)
+        for partition, rows in results:
+            sink.write(rows)
+            if state:
+                state.add(partition)
+            written += len(rows)
+            if progress:
+                progress(written, total)
+    return written
+
+
+def main(argv: List[str] = None) -> None:
+    parser = ArgumentParser(prog='python -m cups.jobs', description='Audit allowed perms of all entities')
+    parser.add_argument('path', help='output file, .csv or JSON lines')
+    parser.add_argument('--concurrency', type=int, default=None, help='worker processes, 0 to run inline')
+    parser.add_argument('--partition-size', type=int, default=500, help='entities per partition')
+    parser.add_argument('--checkpoint', default=None, help='file to resume interrupted audit from')
+    args = parser.parse_args(argv)
+
+    def report(done: int, total: int) -> None:
+        print(f'\r{done}/{total}', end='', flush=True)
+
+    audit(args.path, concurrency=args.concurrency, partition_size=args.partition_size,
+          checkpoint=args.checkpoint, progress=report)
+    print()
+
+
+if __name__ == '__main__':
+    main()
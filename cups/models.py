@@ -1,9 +1,15 @@
 from collections import namedtuple
-from typing import Iterable, List, Optional
+from typing import Iterable, List, Optional, Tuple
 
-from py2neo import cypher_repr
+from py2neo import Node
 
+from cups.backends.base import (
+    ACTIVATED, ALLOW, DENY, ENABLED, EXISTS_IN, INHERITS, IS_IN, IS_IN_AUTO, RELATED_TO, SUBSET_OF, SUPPORTS,
+    ScopeIds, WORKS_IN,
+)
+from cups.cache import Membership, decision_cache
 from cups.db import graph
+from cups.permissions import PermIndex, PermissionMatrix, PermissionSet
 from cups.utils import *
 
 __all__ = [
@@ -15,106 +21,62 @@ __all__ = [
     'EnabledAbility',
 ]
 
-IS_IN = 'IS_IN'
-IS_IN_AUTO = 'IS_IN_AUTO'
-ALLOW = 'ALLOW'
-DENY = 'DENY'
-INHERITS = 'INHERITS'
-EXISTS_IN = 'EXISTS_IN'
-SUBSET_OF = 'SUBSET_OF'
-SUPPORTS = 'SUPPORTS'
-ACTIVATED = 'ACTIVATED'
-ENABLED = 'ENABLED'
-RELATED_TO = 'RELATED_TO'
-WORKS_IN = 'ACTIVATED_IN'
+
+def _get_scope_ids(scope: 'Scope') -> ScopeIds:
+    return graph.get_reachable_ids(Scope.label, scope.id, [SUBSET_OF], Scope.label) + [scope.id, '*']
 
 
 class _HasScope(Model):
     @property
     def scope(self) -> Optional['NodeType']:
-        cursor = graph.run(f'MATCH (i:{self.label}) -[:{EXISTS_IN}]-> (j:{Scope.label}) WHERE id(i)={self.id} RETURN j')
-        if record := get_one(cursor):
-            return Scope.from_node(record['j'])
+        for node, _, _ in graph.match_related(self.label, self.id, [EXISTS_IN], Scope.label):
+            return Scope.from_node(node)
 
     @scope.deleter
     def scope(self) -> None:
         self['__scope_id__'] = None
-        graph.run(f'MATCH (i:{self.label}) -[r:{EXISTS_IN}]-> (:{Scope.label}) WHERE id(i)={self.id} '
-                  f'SET i.__scope_id__ = {cypher_repr(None)} DELETE r')
+        graph.delete_relationships(self.label, self.id, [EXISTS_IN], Scope.label, node_props={'__scope_id__': None})
 
     @scope.setter
     def scope(self, item: 'NodeType') -> None:
-        graph.run(f'MATCH (i:{self.label}) -[r:{EXISTS_IN}]-> (:{Scope.label}) WHERE id(i)={self.id} DELETE r')
+        graph.delete_relationships(self.label, self.id, [EXISTS_IN], Scope.label)
         self['__scope_id__'] = item.id
-        graph.run(
-            f'MATCH (i:{self.label}) WHERE id(i) = {self.id} '
-            f'MATCH (j:{Scope.label}) WHERE id(j) = {item.id} '
-            f'MERGE (i) -[:{EXISTS_IN}]-> (j) SET i.__scope_id__ = {cypher_repr(item.id)}'
-        )
+        graph.merge_relationship(self.label, self.id, EXISTS_IN, Scope.label, item.id,
+                                 node_props={'__scope_id__': item.id})
 
     def is_scope_supported(self, scope: 'Scope' = None) -> None:
-        local = self.scope
-        if not local or (scope and local.id == scope.id):
-            return
-        if not scope:
-            raise ValueError(f'{self.label} only works in scope {local}')
-        cursor = graph.run(
-            f'MATCH (a:{self.label}) WHERE id(a) = {self.id} '
-            f'MATCH (a)-[:{EXISTS_IN}|{SUBSET_OF}*]->(:{Scope.label})<-[:{SUBSET_OF}]-(s:{Scope.label}) '
-            f'WHERE id(s) = {scope.id} RETURN id(s) as i')
-        if not get_one(cursor):
-            raise ValueError(f'{self.label} only works in scope {local}')
+        local, supported = graph.get_scope_support(self.label, self.id, Scope.label, scope.id if scope else None)
+        if local is not None and not supported:
+            raise ValueError(f'{self.label} only works in scope {Scope.from_node(local)}')
 
 
 class Entity(Model):
     def get_groups(self, scope: 'Scope' = None) -> Iterable['Group']:
-        if scope:
-            cursor = graph.run(
-                f'MATCH (s:{Scope.label}) WHERE id(s) = {scope.id} '
-                f'MATCH (e:{self.label}) -[:{IS_IN}]-> (g:{Group.label}) -[:{EXISTS_IN}|{SUBSET_OF}*]-> (s) '
-                f'WHERE NOT (e)-[:{IS_IN_AUTO}]-> (g:{Group.label}) AND id(e) = {self.id} '
-                f'RETURN g'
-            )
-        else:
-            cursor = graph.run(
-                f'MATCH (e:{self.label}) -[:{IS_IN}]-> (g:{Group.label}) '
-                f'WHERE NOT (e)-[:{IS_IN_AUTO}]-> (g:{Group.label}) AND id(e) = {self.id} '
-                f'RETURN g'
-            )
-        for record in cursor:
-            yield Group.from_node(record['g'])
+        for node in graph.match_groups(self.label, self.id, Group.label, Scope.label, scope.id if scope else None):
+            yield Group.from_node(node)
         yield Group.get_global()
 
     def add_to_group(self, group: 'Group'):
-        graph.run(f'MATCH (e:{self.label}) WHERE id(e) = {self.id} '
-                  f'MATCH (g:{Group.label}) WHERE id(g) = {group.id} '
-                  f'MERGE (e)-[:{IS_IN}]->(g)')
+        with decision_cache.local_write(self.id, lambda m: m._replace(groups=m.groups | {group.id})):
+            graph.merge_relationship(self.label, self.id, IS_IN, Group.label, group.id)
 
     def remove_from_group(self, group: 'Group'):
-        graph.run(f'MATCH (e:{self.label})-[r:{IS_IN}]->(g:{Group.label}) '
-                  f'WHERE id(e) = {self.id} and id(g) = {group.id} DELETE r')
+        with decision_cache.local_write(self.id, lambda m: m._replace(groups=m.groups - {group.id})):
+            graph.delete_relationships(self.label, self.id, [IS_IN], Group.label, group.id)
 
     def remove_from_all_groups(self):
-        graph.run(f'MATCH (e:{self.label})-[r:{IS_IN}]->(g:{Group.label}) '
-                  f'WHERE id(e) = {self.id} DELETE r')
+        with decision_cache.local_write(self.id, lambda m: m._replace(groups=frozenset())):
+            graph.delete_relationships(self.label, self.id, [IS_IN], Group.label)
 
     def get_all_activated_abilities(self) -> Iterable['EnabledAbility']:
-        cursor = graph.run(f'MATCH (e:{self.label}) WHERE id(e) = {self.id} '
-                           f'MATCH (e)-[r:{ENABLED}]->(a:{Ability.label}) '
-                           f'RETURN r, a')
-        for record in cursor:
-            ability = Ability.from_node(record['a'])
-            edge = record['r']
+        for node, _, edge in graph.match_related(self.label, self.id, [ENABLED], Ability.label):
+            ability = Ability.from_node(node)
             yield EnabledAbility(ability=ability, perm_id=edge['perm_id'], scope_id=edge['scope_id'])
 
     def get_activated_abilities(self, scope: 'Scope' = None) -> Iterable['Ability']:
-        f = encode_dict({'scope_id': scope.id})
-        cursor = graph.run(f'MATCH (e:{self.label}) WHERE id(e) = {self.id} '
-                           f'MATCH (e)-[r:{ENABLED} {f}]->(a:{Ability.label}) '
-                           f'RETURN r, a')
-        for record in cursor:
-            ability = Ability.from_node(record['a'])
-            edge = record['r']
+        f = {'scope_id': scope.id if scope else '*'}
+        for node, _, edge in graph.match_related(self.label, self.id, [ENABLED], Ability.label, props=f):
+            ability = Ability.from_node(node)
             yield EnabledAbility(ability=ability, perm_id=edge['perm_id'], scope_id=edge['scope_id'])
 
     def activate_ability(self, ability: 'Ability', perm: 'Perm', scope: 'Scope' = None):
@@ -123,127 +85,131 @@ class Entity(Model):
         if not ability.is_perm_supported(perm):
             raise ValueError('Permission is not supported by this ability')
 
-        graph.run(f'MATCH (e:{self.label}) WHERE id(e)={self.id} '
-                  f'MATCH (a:{ability.label}) WHERE id(a)={ability.id} '
-                  f'MERGE (e)-[r:{ENABLED} {{perm_id: {perm.id}}}]->(a)'
-                  f'SET r.scope_id = {cypher_repr(scope.id if scope else "*")}')
+        with decision_cache.local_write(self.id, lambda m: m._replace(direct=True)):
+            graph.merge_relationship(self.label, self.id, ENABLED, ability.label, ability.id,
+                                     props={'perm_id': perm.id}, set_props={'scope_id': scope.id if scope else '*'})
 
     def reset_ability(self, ability: 'Ability', scope: 'Scope' = None):
-        scope_id = cypher_repr(scope.id if scope else '*')
-        graph.run(f'MATCH (e:{self.label})-[r:{ENABLED}]->(a:{ability.label}) '
-                  f'WHERE id(e) = {self.id} AND id(a) = {ability.id} AND r.scope_id = {scope_id} '
-                  f'DELETE r')
+        f = {'scope_id': scope.id if scope else '*'}
+        with decision_cache.local_write(self.id):
+            graph.delete_relationships(self.label, self.id, [ENABLED], ability.label, ability.id, props=f)
 
     def reset_ability_in_all_scopes(self, ability: 'Ability'):
-        graph.run(f'MATCH (e:{self.label})-[r:{ENABLED}]->(a:{ability.label}) '
-                  f'WHERE id(e) = {self.id} AND id(a) = {ability.id} '
-                  f'DELETE r')
+        with decision_cache.local_write(self.id):
+            graph.delete_relationships(self.label, self.id, [ENABLED], ability.label, ability.id)
 
     def reset_all_abilities(self):
-        graph.run(f'MATCH (e:{self.label})-[r:{ENABLED}]->(a:{Ability.label}) '
-                  f'WHERE id(e) = {self.id} DELETE r')
+        with decision_cache.local_write(self.id):
+            graph.delete_relationships(self.label, self.id, [ENABLED], Ability.label)
 
     def save(self, update_fields: List[str] = None):
-        super().save(update_fields=update_fields)
-        graph.run(f'MATCH (e:{self.label})-[r:{IS_IN_AUTO}]->(:{Group.label}) WHERE id(e) = {self.id} DELETE r')
-        graph.run(
-            f'MATCH (e:{self.label}) WHERE id(e) = {self.id} '
-            f'MATCH (g:{Group.label} {encode_dict({"__global__": True})}) '
-            f'MERGE (e)-[r:{IS_IN_AUTO}]->(g)')
+        with decision_cache.local_write(self.id):
+            super().save(update_fields=update_fields)
+            graph.delete_relationships(self.label, self.id, [IS_IN_AUTO], Group.label)
+            graph.merge_relationship(self.label, self.id, IS_IN_AUTO, Group.label, None,
+                                     target_props={'__global__': True})
 
     def get_linked_perms(self, scope: 'Scope' = None) -> (Iterable['Perm'], bool):
         f = {'scope_id': scope.id if scope else '*'}
-        cursor = graph.run(
-            f'MATCH (e:{self.label}) -[r:{ALLOW}|{DENY} {encode_dict(f)}]-> (p:{Perm.label}) '
-            f'WHERE id(e) = {self.id} RETURN p, type(r) as r')
-        for record in cursor:
-            yield Perm.from_node(record['p']), record['r'] == ALLOW
+        for node, type, _ in graph.match_related(self.label, self.id, [ALLOW, DENY], Perm.label, props=f):
+            yield Perm.from_node(node), type == ALLOW
 
     def get_all_linked_perms(self) -> (Iterable['Perm'], bool):
-        cursor = graph.run(
-            f'MATCH (e:{self.label}) -[r:{ALLOW}|{DENY}]-> (p:{Perm.label}) '
-            f'WHERE id(e) = {self.id} RETURN p, type(r) as r')
-        for record in cursor:
-            yield Perm.from_node(record['p']), record['r'] == ALLOW
+        for node, type, _ in graph.match_related(self.label, self.id, [ALLOW, DENY], Perm.label):
+            yield Perm.from_node(node), type == ALLOW
 
     def link_perm(self, perm: 'Perm', /, scope: 'Scope' = None, allow: bool = True):
         perm.is_scope_supported(scope)
-        self.reset_perm(perm, scope=scope)
-        f = {'scope_id': scope.id if scope else '*'}
-        graph.run(f'MATCH (e:{self.label}) WHERE id(e) = {self.id} '
-                  f'MATCH (p:{Perm.label}) WHERE id(p) = {perm.id} '
-                  f'MERGE (e)-[:{ALLOW if allow else DENY} {encode_dict(f)}]->(p)')
+        with decision_cache.local_write(self.id, lambda m: m._replace(direct=True)):
+            self.reset_perm(perm, scope=scope)
+            f = {'scope_id': scope.id if scope else '*'}
+            graph.merge_relationship(self.label, self.id, ALLOW if allow else DENY, Perm.label, perm.id, props=f)
 
     def reset_perm(self, perm: 'Perm', scope: 'Scope' = None):
         f = {'scope_id': scope.id if scope else '*'}
-        graph.run(f'MATCH (e:{self.label})-[r:{ALLOW}|{DENY} {encode_dict(f)}]->(p:{Perm.label}) '
-                  f'WHERE id(e) = {self.id} AND id(p) = {perm.id} DELETE r')
+        with decision_cache.local_write(self.id):
+            graph.delete_relationships(self.label, self.id, [ALLOW, DENY], Perm.label, perm.id, props=f)
 
     def reset_all_perms_in_scope(self, scope: 'Scope' = None):
         f = {'scope_id': scope.id if scope else '*'}
-        graph.run(f'MATCH (e:{self.label})-[r:{ALLOW}|{DENY} {encode_dict(f)}]->(p:{Perm.label}) '
-                  f'WHERE id(e) = {self.id} DELETE r')
+        with decision_cache.local_write(self.id):
+            graph.delete_relationships(self.label, self.id, [ALLOW, DENY], Perm.label, props=f)
 
     def reset_all_perms(self):
-        graph.run(f'MATCH (e:{self.label})-[r:{ALLOW}|{DENY}]->(p:{Perm.label}) '
-                  f'WHERE id(e) = {self.id} DELETE r')
+        with decision_cache.local_write(self.id):
+            graph.delete_relationships(self.label, self.id, [ALLOW, DENY], Perm.label)
+
+    def _get_membership(self, bookmark: Optional[int]) -> Membership:
+        membership = decision_cache.get_membership(self.id, bookmark)
+        if membership is None:
+            # Cache is filled from primary only, replicas may miss writes of other sessions
+            with graph.pinned():
+                generation = decision_cache.generation
+                stamp = graph.get_bookmark() if bookmark is not None else None
+                groups, direct = graph.get_membership(self.label, self.id, Group.label)
+                membership = decision_cache.set_membership(self.id, Membership(
+                    groups=frozenset(i for type, i in groups if type == IS_IN),
+                    auto_groups=frozenset(i for type, i in groups if type == IS_IN_AUTO),
+                    direct=direct,
+                ), generation, stamp)
+        return membership
+
+    def _get_shared_perms(self, scope: 'Scope' = None) -> Optional[Tuple[Node, ...]]:
+        """Allowed perms cached for entities in the same groups, None if entity has own decisions"""
+        if not decision_cache.enabled:
+            return None
+        bookmark = graph.get_session_bookmark()
+        signature = self._get_membership(bookmark).signature
+        if signature is None:
+            return None
+        key = (signature, scope.id if scope else None)
+        perms = decision_cache.get_decision(key, bookmark)
+        if perms is None:
+            with graph.pinned():
+                generation = decision_cache.generation
+                stamp = graph.get_bookmark() if bookmark is not None else None
+                scope_ids = _get_scope_ids(scope) if scope else None
+                perms = decision_cache.set_decision(key, tuple(
+                    graph.match_allowed_perms(self.label, self.id, Perm.label, Scope.label, scope_ids)),
+                    generation, stamp)
+        return perms
 
     def get_allowed_perms(self, scope: 'Scope' = None) -> Iterable['Perm']:
-        if scope:
-            scope_ids = cypher_repr([i['i'] for i in graph.run(
-                f'MATCH (s:{Scope.label})-[:{SUBSET_OF}*]->(ss:{Scope.label}) '
-                f'WHERE id(s) = {scope.id} RETURN id(ss) as i'
-            )] + [scope.id, '*'])
-            cursor = graph.run(f"""
-                MATCH (s:{Scope.label}) WHERE id(s) IN {scope_ids}
-                CALL {{
-                    MATCH (e:{self.label}) WHERE id(e) = {self.id} RETURN e
-                    UNION
-                    WITH s RETURN s as e
-                }} 
-                MATCH r = shortestPath((e)-[*1..16]->(p:{Perm.label}))
-                WITH relationships(r) as r, tail(reverse(tail(reverse(nodes(r))))) as n, p
-                WHERE type(r[-1]) = "ALLOW"
-                    AND (r[-1].scope_id IN {scope_ids} OR NOT EXISTS(r[-1].scope_id))
-                    AND all(i IN n WHERE i.__scope_id__ IN {scope_ids} OR NOT EXISTS(i.__scope_id__))
-                RETURN p""")
-        else:
-            cursor = graph.run(
-                f'MATCH (e:{self.label}) WHERE id(e) = {self.id} '
-                f'MATCH r = shortestPath((e)-[*1..16]->(p:{Perm.label})) '
-                f'WITH type(relationships(r)[-1]) = "{ALLOW}" as k, p '
-                f'WHERE k RETURN p')
-        for record in cursor:
-            yield Perm.from_node(record['p'])
+        perms = self._get_shared_perms(scope)
+        if perms is None:
+            scope_ids = _get_scope_ids(scope) if scope else None
+            perms = graph.match_allowed_perms(self.label, self.id, Perm.label, Scope.label, scope_ids)
+        for node in perms:
+            yield Perm.from_node(node)
 
     def is_able(self, perm: 'Perm', scope: 'Scope' = None) -> bool:
-        if scope:
-            scope_ids = cypher_repr([i['i'] for i in graph.run(
-                f'MATCH (s:{Scope.label})-[:{SUBSET_OF}*]->(ss:{Scope.label}) '
-                f'WHERE id(s) = {scope.id} RETURN id(ss) as i'
-            )] + [scope.id, '*'])
-            cursor = graph.run(f"""
-                MATCH (s:{Scope.label}) WHERE id(s) IN {scope_ids}
-                CALL {{
-                    MATCH (e:{self.label}) WHERE id(e) = {self.id} RETURN e
-                    UNION
-                    WITH s RETURN s as e
-                }} 
-                MATCH (p:{Perm.label}) WHERE id(p) = {perm.id}
-                MATCH r = shortestPath((e)-[*1..16]->(p))
-                WITH relationships(r) as r, tail(reverse(tail(reverse(nodes(r))))) as n, p
-                WHERE type(r[-1]) = "ALLOW"
-                    AND (r[-1].scope_id IN {scope_ids} OR NOT EXISTS(r[-1].scope_id))
-                    AND all(i IN n WHERE i.__scope_id__ IN {scope_ids} OR NOT EXISTS(i.__scope_id__))
-                RETURN id(p) as p""")
-        else:
-            cursor = graph.run(
-                f'MATCH (e:{self.label}) WHERE id(e) = {self.id} '
-                f'MATCH (p:{Perm.label}) WHERE id(p) = {perm.id} '
-                f'MATCH r = shortestPath((e)-[*1..16]->(p)) '
-                f'WITH type(relationships(r)[-1]) = "{ALLOW}" as k, p '
-                f'WHERE k RETURN id(p) as p')
-        return get_one(cursor) is not None
+        perms = self._get_shared_perms(scope)
+        if perms is not None:
+            return any(node.identity == perm.id for node in perms)
+        scope_ids = _get_scope_ids(scope) if scope else None
+        cursor = graph.match_allowed_perms(self.label, self.id, Perm.label, Scope.label, scope_ids, perm_id=perm.id)
+        return next(cursor, None) is not None
+
+    def get_permission_set(self, scope: 'Scope' = None, index: PermIndex = None) -> PermissionSet:
+        """Raise KeyError when an allowed perm is missing from index, e.g. created after it was built"""
+        return PermissionSet.from_perms(index or Perm.get_index(), self.get_allowed_perms(scope))
+
+    @classmethod
+    def get_permission_matrix(cls, entities: Iterable['Entity'], scope: 'Scope' = None,
+                              index: PermIndex = None) -> PermissionMatrix:
+        """Compute allowed perms of many entities with a single query.
+
+        Raise KeyError when an allowed perm is missing from index, like get_permission_set.
+        """
+        index = index or Perm.get_index()
+        ids = [entity.id for entity in entities]
+        matrix = PermissionMatrix(index, dict.fromkeys(ids, 0))
+        if not ids:
+            return matrix
+        scope_ids = _get_scope_ids(scope) if scope else None
+        for id, perm_ids in graph.get_allowed_perm_ids(cls.label, ids, Perm.label, Scope.label, scope_ids).items():
+            matrix.rows[id] = index.mask(perm_ids)
+        return matrix
 
 
 class Group(_HasScope, Model):
@@ -268,170 +234,95 @@ class Group(_HasScope, Model):
                 raise RuntimeError(f'Can not make group {self} global: {global_group} exists')
             global_group.make_optional()
         self['__global__'] = True
-        graph.run(
-            f'MATCH (g:{self.label}) WHERE id(g) = {self.id} '
-            f'MATCH (e:{Entity.label}) '
-            f'MERGE (e)-[:{IS_IN_AUTO}]->(g) '
-            f'SET g.__global__ = true')
+        graph.update_node(self.label, self.id, {'__global__': True})
+        graph.merge_relationship(Entity.label, None, IS_IN_AUTO, self.label, self.id)
 
     def make_optional(self):
         if self.get('__global__') is not True:
             return
         self.pop('__global__')
-        graph.run(f'MATCH (:{Entity.label})-[r:{IS_IN_AUTO}]->(g:{self.label} '
-                  f'WHERE id(g) = {self.id} '
-                  f'SET g.__global__ = null '
-                  f'DELETE r')
+        graph.update_node(self.label, self.id, {'__global__': None})
+        graph.delete_relationships(Entity.label, None, [IS_IN_AUTO], self.label, self.id)
 
     def get_linked_perms(self) -> (Iterable['Perm'], bool):
-        cursor = graph.run(
-            f'MATCH (e:{self.label}) -[r:{ALLOW}|{DENY}]-> (p:{Perm.label}) '
-            f'WHERE id(e) = {self.id} RETURN p, type(r) as r')
-        for record in cursor:
-            yield Perm.from_node(record['p']), record['r'] == ALLOW
+        for node, type, _ in graph.match_related(self.label, self.id, [ALLOW, DENY], Perm.label):
+            yield Perm.from_node(node), type == ALLOW
 
     def link_perm(self, perm: 'Perm', /, allow: bool = True):
         self.reset_perm(perm)
-        graph.run(f'MATCH (e:{self.label}) WHERE id(e) = {self.id} '
-                  f'MATCH (p:{Perm.label}) WHERE id(p) = {perm.id} '
-                  f'MERGE (e)-[:{ALLOW if allow else DENY}]->(p)')
+        graph.merge_relationship(self.label, self.id, ALLOW if allow else DENY, Perm.label, perm.id)
 
     def link_all_perms(self, /, allow: bool = True):
         self.reset_all_perms()
-        graph.run(f'MATCH (e:{self.label}) WHERE id(e) = {self.id} '
-                  f'MATCH (p:{Perm.label}) '
-                  f'MERGE (e)-[:{ALLOW if allow else DENY}]->(p)')
+        graph.merge_relationship(self.label, self.id, ALLOW if allow else DENY, Perm.label, None)
 
     def reset_perm(self, perm: 'Perm'):
-        graph.run(f'MATCH (e:{self.label})-[r:{ALLOW}|{DENY}]->(p:{Perm.label}) '
-                  f'WHERE id(e) = {self.id} AND id(p) = {perm.id} DELETE r')
+        graph.delete_relationships(self.label, self.id, [ALLOW, DENY], Perm.label, perm.id)
 
     def reset_all_perms(self):
-        graph.run(f'MATCH (e:{self.label})-[r:{ALLOW}|{DENY}]->(p:{Perm.label}) '
-                  f'WHERE id(e) = {self.id} DELETE r')
+        graph.delete_relationships(self.label, self.id, [ALLOW, DENY], Perm.label)
 
     def get_allowed_perms(self, scope: 'Scope' = None) -> Iterable['Perm']:
-        if scope:
-            scope_ids = cypher_repr([i['i'] for i in graph.run(
-                f'MATCH (s:{Scope.label})-[:{SUBSET_OF}*]->(ss:{Scope.label}) '
-                f'WHERE id(s) = {scope.id} RETURN id(ss) as i'
-            )] + [scope.id, '*'])
-            cursor = graph.run(f"""
-                MATCH (s:{Scope.label}) WHERE id(s) IN {scope_ids}
-                CALL {{
-                    MATCH (e:{self.label}) WHERE id(e) = {self.id} RETURN e
-                    UNION
-                    WITH s RETURN s as e
-                }} 
-                MATCH r = shortestPath((e)-[*1..16]->(p:{Perm.label}))
-                WITH relationships(r) as r, tail(reverse(tail(reverse(nodes(r))))) as n, p
-                WHERE type(r[-1]) = "ALLOW"
-                    AND (r[-1].scope_id IN {scope_ids} OR NOT EXISTS(r[-1].scope_id))
-                    AND all(i IN n WHERE i.__scope_id__ IN {scope_ids} OR NOT EXISTS(i.__scope_id__))
-                RETURN p""")
-        else:
-            cursor = graph.run(
-                f'MATCH (e:{self.label}) WHERE id(e) = {self.id} '
-                f'MATCH r = shortestPath((e)-[*1..16]->(p:{Perm.label})) '
-                f'WITH type(relationships(r)[-1]) = "{ALLOW}" as k, p '
-                f'WHERE k RETURN p')
-        for record in cursor:
-            yield Perm.from_node(record['p'])
+        scope_ids = _get_scope_ids(scope) if scope else None
+        for node in graph.match_allowed_perms(self.label, self.id, Perm.label, Scope.label, scope_ids):
+            yield Perm.from_node(node)
 
     def is_able(self, perm: 'Perm', scope: 'Scope' = None) -> bool:
-        if scope:
-            scope_ids = cypher_repr([i['i'] for i in graph.run(
-                f'MATCH (s:{Scope.label})-[:{SUBSET_OF}*]->(ss:{Scope.label}) '
-                f'WHERE id(s) = {scope.id} RETURN id(ss) as i'
-            )] + [scope.id, '*'])
-            cursor = graph.run(f"""
-                MATCH (s:{Scope.label}) WHERE id(s) IN {scope_ids}
-                CALL {{
-                    MATCH (e:{self.label}) WHERE id(e) = {self.id} RETURN e
-                    UNION
-                    WITH s RETURN s as e
-                }} 
-                MATCH (p:{Perm.label}) WHERE id(p) = {perm.id}
-                MATCH r = shortestPath((e)-[*1..16]->(p))
-                WITH relationships(r) as r, tail(reverse(tail(reverse(nodes(r))))) as n, p
-                WHERE type(r[-1]) = "ALLOW"
-                    AND (r[-1].scope_id IN {scope_ids} OR NOT EXISTS(r[-1].scope_id))
-                    AND all(i IN n WHERE i.__scope_id__ IN {scope_ids} OR NOT EXISTS(i.__scope_id__))
-                RETURN id(p) as p""")
-        else:
-            cursor = graph.run(
-                f'MATCH (e:{self.label}) WHERE id(e) = {self.id} '
-                f'MATCH (p:{Perm.label}) WHERE id(p) = {perm.id} '
-                f'MATCH r = shortestPath((e)-[*1..16]->(p)) '
-                f'WITH type(relationships(r)[-1]) = "{ALLOW}" as k, p '
-                f'WHERE k RETURN id(p) as p')
-        return get_one(cursor) is not None
+        scope_ids = _get_scope_ids(scope) if scope else None
+        cursor = graph.match_allowed_perms(self.label, self.id, Perm.label, Scope.label, scope_ids, perm_id=perm.id)
+        return next(cursor, None) is not None
+
+    def get_permission_set(self, scope: 'Scope' = None, index: PermIndex = None) -> PermissionSet:
+        return PermissionSet.from_perms(index or Perm.get_index(), self.get_allowed_perms(scope))
 
 
 class Perm(_HasScope, Model):
-    pass
+    @classmethod
+    def get_index(cls) -> PermIndex:
+        """Dense bit positions of all perms, ordered by id"""
+        return PermIndex(graph.get_node_ids(cls.label))
 
 
 class Scope(Model):
     subset_of = ForeignKey('Scope', SUBSET_OF)  # type: Optional['Scope']
 
     def get_linked_perms(self) -> (Iterable['Perm'], bool):
-        cursor = graph.run(
-            f'MATCH (s:{self.label}) -[r:{ALLOW}|{DENY}]-> (p:{Perm.label}) '
-            f'WHERE id(s) = {self.id} RETURN p, type(r) as r')
-        for record in cursor:
-            yield Perm.from_node(record['p']), record['r'] == ALLOW
+        for node, type, _ in graph.match_related(self.label, self.id, [ALLOW, DENY], Perm.label):
+            yield Perm.from_node(node), type == ALLOW
 
     def link_perm(self, perm: 'Perm'):
         self.reset_perm(perm)
-        graph.run(f'MATCH (s:{self.label}) WHERE id(s) = {self.id} '
-                  f'MATCH (p:{Perm.label}) WHERE id(p) = {perm.id} '
-                  f'MERGE (s)-[:{ALLOW}]->(p)')
+        graph.merge_relationship(self.label, self.id, ALLOW, Perm.label, perm.id)
 
     def reset_perm(self, perm: 'Perm'):
-        graph.run(f'MATCH (s:{self.label})-[r:{ALLOW}]->(p:{Perm.label}) '
-                  f'WHERE id(s) = {self.id} AND id(p) = {perm.id} DELETE r')
+        graph.delete_relationships(self.label, self.id, [ALLOW], Perm.label, perm.id)
 
     def reset_all_perms(self):
-        graph.run(f'MATCH (s:{self.label})-[r:{ALLOW}]->(p:{Perm.label}) '
-                  f'WHERE id(s) = {self.id} DELETE r')
+        graph.delete_relationships(self.label, self.id, [ALLOW], Perm.label)
 
 
 class Ability(_HasScope, Model):
     @classmethod
     def get_available_for_scope(cls, scope: 'Scope') -> Iterable['Ability']:
-        cursor = graph.run(
-            f'MATCH (a:{cls.label})-[:{EXISTS_IN}|{SUBSET_OF}*]->(s:{Scope.label}) '
-            f'WHERE id(s) = {scope.id} RETURN a')
-        for record in cursor:
-            return Ability.from_node(record['a'])
+        for node in graph.match_reaching(cls.label, [EXISTS_IN, SUBSET_OF], Scope.label, scope.id):
+            return Ability.from_node(node)
 
     def is_perm_supported(self, perm: 'Perm') -> bool:
-        cursor = graph.run(f'MATCH (a:{self.label})-[:{SUPPORTS}]->(p:{Perm.label}) '
-                           f'WHERE id(a) = {self.id} AND id(p) = {perm.id} RETURN id(p) as i')
-        return get_one(cursor) is not None
+        cursor = graph.match_related(self.label, self.id, [SUPPORTS], Perm.label, perm.id)
+        return next(cursor, None) is not None
 
     def get_supported_perms(self) -> Iterable['Perm']:
-        cursor = graph.run(f'MATCH (a:{self.label}) -[:{SUPPORTS}]-> (p:{Perm.label}) '
-                           f'WHERE id(a) = {self.id} RETURN p')
-        for record in cursor:
-            yield Perm.from_node(record['p'])
+        for node, _, _ in graph.match_related(self.label, self.id, [SUPPORTS], Perm.label):
+            yield Perm.from_node(node)
 
     def add_perm_support(self, perm: 'Perm'):
-        graph.run(f'MATCH (a:{self.label}) WHERE id(a) = {self.id} '
-                  f'MATCH (p:{Perm.label}) WHERE id(p) = {perm.id} '
-                  f'MERGE (a)-[:{SUPPORTS}]->(p)')
+        graph.merge_relationship(self.label, self.id, SUPPORTS, Perm.label, perm.id)
 
     def remove_perm_support(self, perm: 'Perm'):
-        graph.run(f'MATCH (a:{self.label}) WHERE id(a) = {self.id} '
-                  f'MATCH (p:{Perm.label}) WHERE id(p) = {perm.id} '
-                  f'MATCH (a)-[r:{SUPPORTS}]->(p) '
-                  f'DELETE r')
+        graph.delete_relationships(self.label, self.id, [SUPPORTS], Perm.label, perm.id)
 
     def remove_all_supported_perms(self):
-        graph.run(f'MATCH (a:{self.label}) WHERE id(a) = {self.id} '
-                  f'MATCH (a)-[r:{SUPPORTS}]->(:{Perm.label}) '
-                  f'DELETE r')
+        graph.delete_relationships(self.label, self.id, [SUPPORTS], Perm.label)
 
 
 EnabledAbility = namedtuple('EnabledAbility', 'ability perm_id scope_id')
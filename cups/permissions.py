@@ -0,0 +1,254 @@
+from typing import Dict, Iterable, Iterator, List, Set, TYPE_CHECKING, Tuple
+
+import ujson
+
+if TYPE_CHECKING:
+    from cups.models import Perm
+
+__all__ = [
+    'PermIndex',
+    'PermissionSet',
+    'PermissionMatrix',
+]
+
+
+class PermIndex:
+    """Dense mapping of Perm node ids to bit positions"""
+    __slots__ = ('ids', 'positions')
+
+    def __init__(self, ids: Iterable[int] = ()):
+        self.ids = []  # type: List[int]
+        self.positions = {}  # type: Dict[int, int]
+        for id in ids:
+            self.add(id)
+
+    def add(self, id: int) -> int:
+        """Return bit position of perm id, allocating a new one if needed"""
+        if not isinstance(id, int):
+            raise ValueError('Perm ID must be int')
+        if id not in self.positions:
+            self.positions[id] = len(self.ids)
+            self.ids.append(id)
+        return self.positions[id]
+
+    def position(self, id: int) -> int:
+        try:
+            return self.positions[id]
+        except KeyError:
+            raise KeyError(f'Perm {id} is not indexed') from None
+
+    def mask(self, ids: Iterable[int]) -> int:
+        mask = 0
+        for id in ids:
+            mask |= 1 << self.position(id)
+        return mask
+
+    def unpack(self, mask: int) -> Iterator[int]:
+        position = 0
+        while mask:
+            if mask & 1:
+                yield self.ids[position]
+            mask >>= 1
+            position += 1
+
+    @property
+    def full(self) -> int:
+        return (1 << len(self.ids)) - 1
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, id: int) -> bool:
+        return id in self.positions
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, PermIndex) and self.ids == other.ids
+
+    def __repr__(self) -> str:
+        return f'PermIndex({self.ids!r})'
+
+
+class PermissionSet:
+    """Immutable bitmask of allowed perms over a PermIndex.
+
+    Set algebra (``|``, ``&``, ``-``, ``^``) works on sets sharing the same index.
+    """
+    __slots__ = ('index', 'mask')
+
+    def __init__(self, index: PermIndex, mask: int = 0):
+        if mask < 0 or mask >> len(index):
+            raise ValueError('Mask does not fit perm index')
+        self.index = index
+        self.mask = mask
+
+    @classmethod
+    def from_ids(cls, index: PermIndex, ids: Iterable[int]) -> 'PermissionSet':
+        return cls(index, index.mask(ids))
+
+    @classmethod
+    def from_perms(cls, index: PermIndex, perms: Iterable['Perm']) -> 'PermissionSet':
+        return cls.from_ids(index, [perm.id for perm in perms])
+
+    @property
+    def ids(self) -> Set[int]:
+        return set(self.index.unpack(self.mask))
+
+    def is_able(self, perm: 'Perm') -> bool:
+        return perm.id in self
+
+    def is_able_many(self, perms: Iterable['Perm']) -> bool:
+        """Check that every perm is allowed, perms missing from index are not"""
+        ids = [perm.id for perm in perms]
+        if not all(id in self.index for id in ids):
+            return False
+        return self.issuperset(PermissionSet.from_ids(self.index, ids))
+
+    def issubset(self, other: 'PermissionSet') -> bool:
+        self._check(other)
+        return self.mask & ~other.mask == 0
+
+    def issuperset(self, other: 'PermissionSet') -> bool:
+        return other.issubset(self)
+
+    def invert(self) -> 'PermissionSet':
+        return PermissionSet(self.index, self.index.full & ~self.mask)
+
+    def _check(self, other) -> None:
+        if not isinstance(other, PermissionSet):
+            raise TypeError('PermissionSet expected')
+        if other.index is not self.index and other.index != self.index:
+            raise ValueError('Permission sets use different perm indexes')
+
+    def __or__(self, other: 'PermissionSet') -> 'PermissionSet':
+        self._check(other)
+        return PermissionSet(self.index, self.mask | other.mask)
+
+    def __and__(self, other: 'PermissionSet') -> 'PermissionSet':
+        self._check(other)
+        return PermissionSet(self.index, self.mask & other.mask)
+
+    def __sub__(self, other: 'PermissionSet') -> 'PermissionSet':
+        self._check(other)
+        return PermissionSet(self.index, self.mask & ~other.mask)
+
+    def __xor__(self, other: 'PermissionSet') -> 'PermissionSet':
+        self._check(other)
+        return PermissionSet(self.index, self.mask ^ other.mask)
+
+    def __contains__(self, id: int) -> bool:
+        position = self.index.positions.get(id)
+        return position is not None and bool(self.mask >> position & 1)
+
+    def __iter__(self) -> Iterator[int]:
+        return self.index.unpack(self.mask)
+
+    def __len__(self) -> int:
+        return bin(self.mask).count('1')
+
+    def __bool__(self) -> bool:
+        return self.mask != 0
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, PermissionSet):
+            return NotImplemented
+        return self.index == other.index and self.mask == other.mask
+
+    def __hash__(self) -> int:
+        return hash(self.mask)
+
+    def __repr__(self) -> str:
+        return f'PermissionSet({sorted(self)!r})'
+
+    def to_dict(self) -> dict:
+        return {'index': self.index.ids, 'mask': hex(self.mask)}
+
+    @classmethod
+    def from_dict(cls, data: dict, index: PermIndex = None) -> 'PermissionSet':
+        """Restore set, reusing index when it matches the serialized one"""
+        stored = PermIndex(data['index'])
+        if index is None or index != stored:
+            index = stored
+        return cls(index, int(data['mask'], 16))
+
+    def dumps(self) -> str:
+        return ujson.dumps(self.to_dict())
+
+    @classmethod
+    def loads(cls, data: str, index: PermIndex = None) -> 'PermissionSet':
+        return cls.from_dict(ujson.loads(data), index=index)
+
+
+class PermissionMatrix:
+    """Permission sets of many entities over one PermIndex, keyed by entity id"""
+    __slots__ = ('index', 'rows')
+
+    def __init__(self, index: PermIndex, rows: Dict[int, int] = None):
+        self.index = index
+        self.rows = dict(rows or {})
+
+    def __getitem__(self, entity_id: int) -> PermissionSet:
+        return PermissionSet(self.index, self.rows.get(entity_id, 0))
+
+    def __setitem__(self, entity_id: int, value: PermissionSet) -> None:
+        PermissionSet(self.index)._check(value)
+        self.rows[entity_id] = value.mask
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.rows)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, PermissionMatrix):
+            return NotImplemented
+        return self.index == other.index and self.rows == other.rows
+
+    def items(self) -> Iterator[Tuple[int, PermissionSet]]:
+        for entity_id in self.rows:
+            yield entity_id, self[entity_id]
+
+    def reindex(self, index: PermIndex) -> 'PermissionMatrix':
+        """Project rows onto another index, dropping perms missing from it"""
+        if index == self.index:
+            return self
+        rows = {}
+        for entity_id, mask in self.rows.items():
+            rows[entity_id] = index.mask([i for i in self.index.unpack(mask) if i in index])
+        return PermissionMatrix(index, rows)
+
+    def diff(self, other: 'PermissionMatrix') -> Dict[int, Tuple[Set[int], Set[int]]]:
+        """Return {entity id: (granted perm ids, revoked perm ids)} going from self to other"""
+        index = PermIndex(self.index.ids + other.index.ids)
+        before, after = self.reindex(index), other.reindex(index)
+        result = {}
+        for entity_id in set(before.rows) | set(after.rows):
+            old, new = before.rows.get(entity_id, 0), after.rows.get(entity_id, 0)
+            if old != new:
+                result[entity_id] = (set(index.unpack(new & ~old)), set(index.unpack(old & ~new)))
+        return result
+
+    def to_numpy(self, entity_ids: List[int] = None):
+        """Return (entity ids, bool array of shape [entities, perms]). Requires numpy"""
+        import numpy
+
+        entity_ids = list(self.rows) if entity_ids is None else entity_ids
+        width = (len(self.index) + 7) // 8
+        data = b''.join(self.rows.get(entity_id, 0).to_bytes(width, 'little') for entity_id in entity_ids)
+        bits = numpy.frombuffer(data, dtype=numpy.uint8).reshape(len(entity_ids), width)
+        array = numpy.unpackbits(bits, axis=1, bitorder='little')[:, :len(self.index)].astype(bool)
+        return entity_ids, array
+
+    def to_dict(self) -> dict:
+        return {'index': self.index.ids, 'rows': {str(k): hex(v) for k, v in self.rows.items()}}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'PermissionMatrix':
+        return cls(PermIndex(data['index']), {int(k): int(v, 16) for k, v in data['rows'].items()})
+
+    def dumps(self) -> str:
+        return ujson.dumps(self.to_dict())
+
+    @classmethod
+    def loads(cls, data: str) -> 'PermissionMatrix':
+        return cls.from_dict(ujson.loads(data))
@@ -0,0 +1,33 @@
+"""Pytest plugin guarding database round trips.
+
+Enable with ``pytest_plugins = ['cups.testing']`` in conftest.py::
+
+    def test_is_able(assert_max_queries):
+        with assert_max_queries(2):
+            user.is_able(perm)
+"""
+from contextlib import contextmanager
+from typing import Iterator, List
+
+from pytest import fixture
+
+from cups.db import count_queries
+
+__all__ = [
+    'max_queries',
+    'assert_max_queries',
+]
+
+
+@contextmanager
+def max_queries(n: int) -> Iterator[List[str]]:
+    """Fail if more than n statements are sent to the database inside the block"""
+    with count_queries() as statements:
+        yield statements
+    if len(statements) > n:
+        raise AssertionError(f'{len(statements)} queries executed, {n} allowed:\n' + '\n'.join(statements))
+
+
+@fixture
+def assert_max_queries():
+    return max_queries
@@ -1,8 +1,9 @@
 from typing import Iterable, List, Optional, TypeVar
 
 from py2neo import Node, Record
-from py2neo.cypher import cypher_escape, cypher_repr
+from py2neo.cypher import cypher_repr
 
+from cups.cypher import encode_dict, encode_filter
 from cups.db import graph
 
 __all__ = [
@@ -15,32 +16,6 @@ __all__ = [
 ]
 
 
-def encode_dict(obj: dict) -> str:
-    for key, value in obj.items():
-        if not isinstance(key, str):
-            raise ValueError('Key must be str')
-        elif not isinstance(value, (int, float, bool, str)) and value is not None:
-            raise ValueError('Value must be number, bool, str or null')
-    return cypher_repr(obj)
-
-
-def encode_filter(id: int = None, /, **kwargs) -> str:
-    f = []
-    if id is not None:
-        if not isinstance(id, int):
-            raise ValueError('Model ID must be int')
-        f.append(f'id(i) = {id}')
-    if kwargs:
-        for key, value in kwargs.items():
-            if not isinstance(value, (int, float, bool, str)) and value is not None:
-                raise ValueError('Invalid property data type')
-            try:
-                f.append(f'i.{cypher_escape(key)} = {cypher_repr(value)}')
-            except ValueError:
-                raise ValueError('Invalid property data')
-    return ' AND '.join(f)
-
-
 def get_one(cursor) -> Optional[Record]:
     try:
         return next(cursor)
@@ -59,28 +34,17 @@ class _ModelType(type):
 def foreign_key(model_name: str, relationship: str):
     def _get(self) -> Optional['NodeType']:
         model = Model.get_model(model_name)
-        cursor = graph.run(
-            f'MATCH (i:{self.label}) -[:{relationship}]-> (j:{model.label}) '
-            f'WHERE id(i) = {self.id} RETURN j'
-        )
-        if record := get_one(cursor):
-            return model.from_node(record['j'])
+        for node, _, _ in graph.match_related(self.label, self.id, [relationship], model.label):
+            return model.from_node(node)
 
     def _del(self) -> None:
         model = Model.get_model(model_name)
-        graph.run(
-            f'MATCH (i:{self.label}) -[r:{relationship}]-> (:{model.label}) '
-            f'WHERE id(i) = {self.id} DELETE r'
-        )
+        graph.delete_relationships(self.label, self.id, [relationship], model.label)
 
     def _set(self, item: 'NodeType') -> None:
         _del(self)
         model = Model.get_model(model_name)
-        graph.run(
-            f'MATCH (i:{self.label}) WHERE id(i) = {self.id} '
-            f'MATCH (j:{model.label}) WHERE id(j) = {item.id} '
-            f'MERGE (i) -[:{relationship}]-> (j)'
-        )
+        graph.merge_relationship(self.label, self.id, relationship, model.label, item.id)
 
     return property(_get, _set, _del)
 
@@ -102,25 +66,20 @@ class Model(dict, metaclass=_ModelType):
 
     @classmethod
     def get_one(cls, id: int = None, /, **kwargs) -> Optional['NodeType']:
-        cursor = graph.run(f'MATCH (i:{cls.label}) WHERE {encode_filter(id, **kwargs)} RETURN i')
-        record = get_one(cursor)
-        if record:
-            return cls.from_node(record['i'])
+        for node in graph.match_nodes(cls.label, id, kwargs, limit=1):
+            return cls.from_node(node)
 
     @classmethod
     def get_or_create(cls, default: dict = None, **kwargs) -> Optional['NodeType']:
         """Attempt to find one by kwargs, otherwise create with kwargs and default"""
-        record = get_one(graph.run(f'MATCH (i:{cls.label} {encode_dict(kwargs)}) RETURN i'))
-        if record:
-            return cls.from_node(record['i'])
-        else:
-            return cls.create(**{**kwargs, **(default or {})})
+        for node in graph.match_nodes(cls.label, props=kwargs, limit=1):
+            return cls.from_node(node)
+        return cls.create(**{**kwargs, **(default or {})})
 
     @classmethod
     def get_all(cls, id: int = None, /, **kwargs) -> Iterable['NodeType']:
-        cursor = graph.run(f'MATCH (i:{cls.label}) WHERE {encode_filter(id, **kwargs)} RETURN i')
-        for record in cursor:
-            yield cls.from_node(record['i'])
+        for node in graph.match_nodes(cls.label, id, kwargs):
+            yield cls.from_node(node)
 
     @classmethod
     def from_node(cls, node: Node) -> 'NodeType':
@@ -147,17 +106,13 @@ class Model(dict, metaclass=_ModelType):
             fields = set(self.keys())
             if update_fields:
                 fields &= set(update_fields)
-            data = ', '.join([
-                f'i.{cypher_escape(field)} = {cypher_repr(self[field])}'
-                for field in fields
-            ])
-            graph.run(f'MATCH (i:{self.label}) WHERE id(i) = {self.id} SET {data} RETURN i')
+            graph.update_node(self.label, self.id, {field: self[field] for field in fields})
         else:
-            self.id = next(graph.run(f'CREATE (i:{self.label} {encode_dict(self)}) RETURN id(i) as i'))['i']
+            self.id = graph.create_node(self.label, dict(self))
 
     def delete(self):
         if self.id:
-            graph.run(f'MATCH (i:{self.label}) WHERE id(i) = {self.id} DETACH DELETE i')
+            graph.delete_node(self.label, self.id)
             self.id = None
 
     def __init_subclass__(cls, *args, **kwargs) -> None:
@@ -2,13 +2,21 @@ import asyncio
 import logging
 import platform
 
-from py2neo import Graph
 from pytest import fixture
 
+from cups.backends import Backend
+
+pytest_plugins = ['cups.testing']
+
 # noinspection PyArgumentList
 # logging.basicConfig(level='DEBUG', force=True)
 
 
+def pytest_addoption(parser):
+    parser.addoption('--update-query-budget', action='store_true',
+                     help='Record measured round trips into tests/query_budget.json')
+
+
 @fixture(scope='session')
 def event_loop():
     if platform.system() == 'Windows':
@@ -18,7 +26,7 @@ def event_loop():
 
 
 @fixture(scope='session')
-def graph() -> Graph:
+def graph() -> Backend:
     import cups.db
     return cups.db.graph
 
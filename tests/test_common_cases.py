@@ -1,3 +1,5 @@
+from pytest import raises
+
 from cups.models import Ability, EnabledAbility, Entity, Group, Perm, Scope
 
 
@@ -107,3 +109,44 @@ def test_complicated_perms_links(clear_db):
     assert not adam.is_able(fly2, modpack)
 
     assert set(adam.get_activated_abilities(server)) == {EnabledAbility(fly, fly1.id, server.id)}
+
+
+
+def test_stale_perm_index_raises(clear_db):
+    user = User.create(name='Adam')
+    select = Perm.create(name='select')
+    Group.get_global().link_perm(select)
+    index = Perm.get_index()
+    update = Perm.create(name='update')
+    Group.get_global().link_perm(update)
+    with raises(KeyError):
+        user.get_permission_set(index=index)
+    with raises(KeyError):
+        User.get_permission_matrix([user], index=index)
+    assert User.get_permission_matrix([user])[user.id].ids == {select.id, update.id}
+
+
+def test_scope_check_ignores_stale_instances(clear_db):
+    server = Scope.create(name='Server')
+    other = Scope.create(name='Other')
+    fly = Perm.create(name='fly')
+    stale = Perm.get_one(fly.id)
+    fly.scope = server
+    user = User.create(name='Adam')
+    for perm in (stale, Perm(fly.id)):
+        with raises(ValueError):
+            user.link_perm(perm, scope=other)
+        with raises(ValueError):
+            user.link_perm(perm)
+    user.link_perm(stale, scope=server)
+    assert user.is_able(fly, server)
+
+
+def test_ability_available_for_scope(clear_db):
+    modpack = Scope.create(name='Modpack')
+    server = Scope.create(name='Server')
+    server.subset_of = modpack
+    fly = Ability.create(name='Fly')
+    fly.scope = server
+    assert Ability.get_available_for_scope(modpack) == fly
+    assert Ability.get_available_for_scope(Scope.create(name='Other')) is None
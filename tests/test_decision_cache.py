@@ -0,0 +1,198 @@
+import sys
+import threading
+
+from pytest import fixture, mark
+
+import cups.models
+import cups.utils
+from cups.backends import connect
+from cups.cache import DecisionCache, Membership, decision_cache
+from cups.db import graph
+from cups.models import Entity, Group, Perm, Scope, _get_scope_ids
+
+
+class User(Entity):
+    pass
+
+
+@fixture(autouse=True)
+def enable_cache():
+    ttl, decision_cache.ttl = decision_cache.ttl, 60
+    size = decision_cache.size
+    decision_cache.clear()
+    yield
+    decision_cache.ttl, decision_cache.size = ttl, size
+    decision_cache.clear()
+
+
+@fixture
+def router(tmp_path, monkeypatch):
+    router = connect(f'sqlite:///{tmp_path}/primary.db', [f'sqlite:///{tmp_path}/replica.db'])
+    router.write_listeners.append(decision_cache.on_write)
+    for module in (cups.models, cups.utils):
+        monkeypatch.setattr(module, 'graph', router)
+    yield router
+    for backend in (router.primary, *router.replicas):
+        backend.connection.close()
+
+
+# Bookmark checks of routed reads add round trips
+counts_queries = mark.skipif(graph.get_session_bookmark() is not None, reason='Reads check replica bookmarks')
+
+
+def replicate(router):
+    router.primary.connection.backup(router.replicas[0].connection)
+
+
+def _uncached_ids(entity: Entity, scope: Scope = None) -> set:
+    scope_ids = _get_scope_ids(scope) if scope else None
+    nodes = graph.match_allowed_perms(entity.label, entity.id, Perm.label, Scope.label, scope_ids)
+    return {node.identity for node in nodes}
+
+
+def _ids(entity: Entity, scope: Scope = None) -> set:
+    return {perm.id for perm in entity.get_allowed_perms(scope)}
+
+
+def _setup():
+    select = Perm.create(name='select')
+    update = Perm.create(name='update')
+    users = Group.create(name='Users')
+    users.make_global(force=True)
+    editors = Group.create(name='Editors')
+    users.link_perm(select)
+    editors.link_perm(update)
+    adam = User.create(name='Adam')
+    ivan = User.create(name='Ivan')
+    adam.add_to_group(editors)
+    ivan.add_to_group(editors)
+    return select, update, users, editors, adam, ivan
+
+
+@counts_queries
+def test_same_groups_share_decisions(assert_max_queries, clear_db):
+    select, update, users, editors, adam, ivan = _setup()
+    assert adam.is_able(update)
+    with assert_max_queries(1):
+        assert ivan.is_able(update)
+    with assert_max_queries(0):
+        assert ivan.is_able(select)
+        assert _ids(ivan) == _ids(adam) == {select.id, update.id}
+
+
+@counts_queries
+def test_membership_changes_keep_decisions_exact(assert_max_queries, clear_db):
+    select, update, users, editors, adam, ivan = _setup()
+    assert adam.is_able(update) and ivan.is_able(update)
+
+    ivan.remove_from_group(editors)
+    with assert_max_queries(1):
+        assert not ivan.is_able(update)
+    assert _ids(ivan) == _uncached_ids(ivan) == {select.id}
+
+    ivan.add_to_group(editors)
+    with assert_max_queries(0):
+        assert ivan.is_able(update)
+
+    ivan.remove_from_all_groups()
+    assert _ids(ivan) == _uncached_ids(ivan) == {select.id}
+
+
+def test_direct_links_bypass_shared_decisions(clear_db):
+    select, update, users, editors, adam, ivan = _setup()
+    assert ivan.is_able(update)
+
+    ivan.link_perm(update, allow=False)
+    assert decision_cache.get_membership(ivan.id).direct
+    assert not ivan.is_able(update)
+    assert adam.is_able(update)
+    assert _ids(ivan) == _uncached_ids(ivan) == {select.id}
+
+    ivan.reset_perm(update)
+    assert ivan.is_able(update)
+    assert _ids(ivan) == _uncached_ids(ivan) == {select.id, update.id}
+
+
+def test_policy_writes_invalidate_decisions(clear_db):
+    select, update, users, editors, adam, ivan = _setup()
+    server = Scope.create(name='Server')
+    assert adam.is_able(update) and adam.is_able(select, server)
+
+    editors.link_perm(update, allow=False)
+    assert not ivan.is_able(update)
+
+    users.make_optional()
+    assert not ivan.is_able(select)
+    assert _ids(adam) == _uncached_ids(adam) == set()
+    assert _ids(adam, server) == _uncached_ids(adam, server)
+
+
+def test_cache_is_not_filled_from_replicas(router):
+    select, update, users, editors, adam, ivan = _setup()
+    replicate(router)
+    with router.session():
+        editors.link_perm(update, allow=False)
+        # Another session without bookmark would read the lagging replica
+        with router.session():
+            assert not ivan.is_able(update)
+        assert not adam.is_able(update)
+
+
+def test_newer_session_skips_cached_decisions(router):
+    select, update, users, editors, adam, ivan = _setup()
+    replicate(router)
+    with router.session():
+        assert ivan.is_able(update)
+
+    # Write of another process, this cache is not notified
+    router.write_listeners.remove(decision_cache.on_write)
+    with router.session():
+        editors.link_perm(update, allow=False)
+        router.write_listeners.append(decision_cache.on_write)
+        assert not ivan.is_able(update)
+        assert not adam.is_able(update)
+
+
+def test_cache_size_is_bounded(clear_db):
+    decision_cache.size = 2
+    select, update, users, editors, adam, ivan = _setup()
+    groups = [Group.create(name=f'group{i}') for i in range(3)]
+    for group in groups:
+        user = User.create(name=group['name'])
+        user.add_to_group(group)
+        assert user.is_able(select)
+    assert len(decision_cache.memberships) == len(decision_cache.decisions) == 2
+
+
+def test_cache_is_thread_safe():
+    cache = DecisionCache(60, size=4)
+    membership = Membership(frozenset(), frozenset(), False)
+    errors = []
+    interval = sys.getswitchinterval()
+    # Switch threads as often as possible to hit interleaved lookups and evictions
+    sys.setswitchinterval(1e-6)
+
+    def work(n: int):
+        try:
+            for i in range(2000):
+                key = (n + i) % 8
+                cache.set_decision(key, (), cache.generation)
+                cache.get_decision(key)
+                cache.set_membership(key, membership, cache.generation)
+                with cache.local_write(key, lambda m: m):
+                    cache.get_membership(key)
+                if i % 50 == 0:
+                    cache.clear()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert errors == []
+    assert len(cache.memberships) <= 4 and len(cache.decisions) <= 4
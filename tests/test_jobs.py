@@ -0,0 +1,118 @@
+import csv
+
+import ujson
+from pytest import fixture, mark, raises
+
+from cups.backends.sqlite import SQLiteBackend
+from cups.db import graph
+from cups.jobs import Checkpoint, Partition, audit
+from cups.models import Entity, Group, Perm, Scope
+
+
+class User(Entity):
+    pass
+
+
+class Interrupted(Exception):
+    pass
+
+
+@fixture
+def expected(clear_db):
+    modpack = Scope.create(name='Modpack')
+    server = Scope.create(name='Server')
+    server.subset_of = modpack
+    select = Perm.create(name='select')
+    fly = Perm.create(name='fly')
+    fly.scope = server
+    users = Group.create(name='Users')
+    users.make_global(force=True)
+    users.link_perm(select)
+    pilots = Group.create(name='Pilots')
+    pilots.link_perm(fly)
+    entities = [User.create(name=f'user{i}') for i in range(5)]
+    entities[0].add_to_group(pilots)
+    entities[1].link_perm(select, allow=False)
+    return {
+        (entity.id, scope.id if scope else None): sorted(perm.id for perm in entity.get_allowed_perms(scope))
+        for entity in entities
+        for scope in (None, modpack, server)
+    }
+
+
+def _read_jsonl(path) -> list:
+    with open(path) as fh:
+        return [ujson.loads(line) for line in fh]
+
+
+def test_audit_jsonl(expected, tmp_path):
+    path = tmp_path / 'audit.jsonl'
+    progress = []
+    assert audit(str(path), concurrency=0, partition_size=2, progress=lambda *a: progress.append(a)) == len(expected)
+    rows = _read_jsonl(path)
+    assert {(row['entity'], row['scope']): row['perms'] for row in rows} == expected
+    assert len(rows) == len(expected)
+    assert progress[-1] == (len(expected), len(expected))
+
+
+def test_audit_csv(expected, tmp_path):
+    path = tmp_path / 'audit.csv'
+    audit(str(path), concurrency=0)
+    with open(path, newline='') as fh:
+        rows = list(csv.DictReader(fh))
+    assert {
+        (int(row['entity']), int(row['scope']) if row['scope'] else None): [int(i) for i in row['perms'].split()]
+        for row in rows
+    } == expected
+
+
+def test_audit_resumes_from_checkpoint(expected, tmp_path):
+    path, checkpoint = tmp_path / 'audit.jsonl', tmp_path / 'audit.checkpoint'
+
+    def interrupt(done, total):
+        if done >= 4:
+            raise Interrupted
+
+    with raises(Interrupted):
+        audit(str(path), concurrency=0, partition_size=2, checkpoint=str(checkpoint), progress=interrupt)
+    assert len(_read_jsonl(path)) == 4
+
+    assert audit(str(path), concurrency=0, partition_size=2, checkpoint=str(checkpoint)) == len(expected) - 4
+    rows = _read_jsonl(path)
+    assert len(rows) == len(expected)
+    assert {(row['entity'], row['scope']): row['perms'] for row in rows} == expected
+
+
+def test_audit_overwrites_output_without_checkpoint(expected, tmp_path):
+    path = tmp_path / 'audit.jsonl'
+    audit(str(path), concurrency=0)
+    audit(str(path), concurrency=0)
+    assert len(_read_jsonl(path)) == len(expected)
+
+
+def test_checkpoint_keeps_exact_ids(tmp_path):
+    path = str(tmp_path / 'audit.checkpoint')
+    Checkpoint(path).add(Partition(None, None, (1, 3)))
+    checkpoint = Checkpoint(path)
+    # Id 2 may belong to an entity created after the partition was audited
+    assert checkpoint.is_done(None, 1) and checkpoint.is_done(None, 3)
+    assert not checkpoint.is_done(None, 2)
+    assert not checkpoint.is_done(7, 1)
+
+
+@mark.skipif(not graph.shareable, reason='In-memory database is not shared with workers')
+def test_audit_process_pool(expected, tmp_path):
+    path = tmp_path / 'audit.jsonl'
+    assert audit(str(path), concurrency=2, partition_size=2) == len(expected)
+    assert {(row['entity'], row['scope']): row['perms'] for row in _read_jsonl(path)} == expected
+
+
+def test_audit_runs_inline_without_shared_database(expected, tmp_path, monkeypatch):
+    assert not SQLiteBackend('sqlite://').shareable
+    monkeypatch.setattr(type(graph), 'shareable', property(lambda self: False))
+    path = tmp_path / 'audit.jsonl'
+    with raises(ValueError):
+        audit(str(path), concurrency=2)
+    # Workers would each open an empty database, so the default runs in this process
+    assert audit(str(path)) == len(expected)
+    assert {(row['entity'], row['scope']): row['perms'] for row in _read_jsonl(path)} == expected
@@ -0,0 +1,107 @@
+from pytest import importorskip, raises
+
+from cups.models import Entity, Group, Perm, Scope
+from cups.permissions import PermIndex, PermissionMatrix, PermissionSet
+
+
+class User(Entity):
+    pass
+
+
+def test_permission_set_algebra():
+    index = PermIndex([10, 20, 30, 40])
+    users = PermissionSet.from_ids(index, [10])
+    editors = PermissionSet.from_ids(index, [20, 30])
+    denied = PermissionSet.from_ids(index, [30])
+
+    allowed = (users | editors) - denied
+    assert allowed.ids == {10, 20}
+    assert 20 in allowed and 30 not in allowed and 99 not in allowed
+    assert len(allowed) == 2
+    assert allowed.issubset(users | editors)
+    assert allowed.invert().ids == {30, 40}
+    assert (allowed ^ editors).ids == {10, 30}
+
+    with raises(ValueError):
+        allowed | PermissionSet.from_ids(PermIndex([10]), [10])
+
+
+def test_permission_set_is_able_many():
+    index = PermIndex([1, 2, 3])
+    allowed = PermissionSet.from_ids(index, [1, 2])
+    assert allowed.is_able_many([Perm(1), Perm(2)])
+    assert not allowed.is_able_many([Perm(1), Perm(3)])
+    # Perm created after index was built is not allowed, like with is_able
+    assert not allowed.is_able(Perm(4))
+    assert not allowed.is_able_many([Perm(1), Perm(4)])
+
+
+def test_permission_set_serialization():
+    index = PermIndex([5, 7, 9])
+    value = PermissionSet.from_ids(index, [5, 9])
+    assert PermissionSet.loads(value.dumps()) == value
+    assert PermissionSet.loads(value.dumps(), index=index).index is index
+
+
+def test_permission_matrix_diff():
+    before = PermissionMatrix(PermIndex([1, 2]), {100: 0b01, 200: 0b11})
+    after = PermissionMatrix(PermIndex([1, 2, 3]), {100: 0b101, 200: 0b11, 300: 0b010})
+
+    assert before.diff(after) == {
+        100: ({3}, set()),
+        300: ({2}, set()),
+    }
+    assert after.diff(before) == {
+        100: (set(), {3}),
+        300: (set(), {2}),
+    }
+    assert PermissionMatrix.loads(after.dumps()) == after
+    assert after[100].ids == {1, 3}
+
+
+def test_permission_matrix_to_numpy():
+    numpy = importorskip('numpy')
+    index = PermIndex(range(10))
+    matrix = PermissionMatrix(index, {100: 0b1000000001, 200: 0b0100})
+    ids, array = matrix.to_numpy([200, 100, 300])
+    assert ids == [200, 100, 300]
+    assert array.dtype == bool and array.shape == (3, 10)
+    assert numpy.flatnonzero(array[0]).tolist() == [2]
+    assert numpy.flatnonzero(array[1]).tolist() == [0, 9]
+    assert not array[2].any()
+    assert PermissionMatrix(PermIndex()).to_numpy()[1].shape == (0, 0)
+
+
+def test_permission_matrix_matches_allowed_perms(clear_db):
+    adam, ivan, guest = (User.create(name=name) for name in ('Adam', 'Ivan', 'Guest'))
+    modpack = Scope.create(name='Modpack')
+    server = Scope.create(name='Server')
+    server.subset_of = modpack
+    select, create, update = (Perm.create(name=name) for name in ('select', 'create', 'update'))
+    fly = Perm.create(name='fly')
+    fly.scope = server
+
+    users = Group.create(name='Users')
+    users.make_global(force=True)
+    users.link_perm(select)
+    editors = Group.create(name='Editors')
+    editors.link_perm(update)
+    moderators = Group.create(name='Moderators')
+    moderators.inherits = editors
+    moderators.link_perm(create)
+    adam.add_to_group(moderators)
+    ivan.add_to_group(editors)
+    adam.link_perm(update, allow=False)
+    guest.link_perm(fly, scope=server)
+
+    index = Perm.get_index()
+    everyone = [adam, ivan, guest]
+    for scope in (None, modpack, server):
+        matrix = User.get_permission_matrix(everyone, scope=scope, index=index)
+        for user in everyone:
+            assert matrix[user.id] == user.get_permission_set(scope=scope, index=index)
+            assert matrix[user.id].ids == {perm.id for perm in user.get_allowed_perms(scope=scope)}
+    assert adam.get_permission_set(index=index).is_able_many([select, create])
+    assert not adam.get_permission_set(index=index).is_able(update)
+    assert guest.get_permission_set(scope=server, index=index).is_able(fly)
+    assert not guest.get_permission_set(scope=modpack, index=index).is_able(fly)
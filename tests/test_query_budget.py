@@ -0,0 +1,205 @@
+import json
+import os
+from inspect import ismemberdescriptor
+from types import SimpleNamespace
+
+from pytest import fixture, mark, skip
+
+from cups.cache import decision_cache
+from cups.db import count_queries
+from cups.models import Ability, Entity, Group, Perm, Scope
+
+BUDGET_FILE = os.path.join(os.path.dirname(__file__), 'query_budget.json')
+
+
+class User(Entity):
+    pass
+
+
+def build_reference_graph() -> SimpleNamespace:
+    g = SimpleNamespace()
+    g.modpack = Scope.create(name='Modpack')
+    g.server = Scope.create(name='Server')
+    g.server.subset_of = g.modpack
+
+    g.select = Perm.create(name='select')
+    g.update = Perm.create(name='update')
+    g.fly = Perm.create(name='fly')
+    g.fly.scope = g.server
+
+    g.users = Group.create(name='Users')
+    g.users.make_global(force=True)
+    g.editors = Group.create(name='Editors')
+    g.moderators = Group.create(name='Moderators')
+    g.moderators.inherits = g.editors
+    g.moderators.scope = g.modpack
+
+    g.users.link_perm(g.select)
+    g.editors.link_perm(g.update)
+    g.modpack.link_perm(g.fly)
+
+    g.ability = Ability.create(name='Fly')
+    g.ability.scope = g.modpack
+    g.ability.add_perm_support(g.fly)
+
+    g.adam = User.create(name='Adam')
+    g.adam.add_to_group(g.moderators)
+    g.adam.link_perm(g.fly, scope=g.server)
+    g.adam.activate_ability(g.ability, g.fly, scope=g.server)
+    g.ivan = User.create(name='Ivan')
+    return g
+
+
+def _set(obj, name, value):
+    setattr(obj, name, value)
+
+
+def _del(obj, name):
+    delattr(obj, name)
+
+
+def _has_scope_cases(name: str, attr: str) -> dict:
+    return {
+        f'{name}.scope': lambda g: getattr(g, attr).scope,
+        f'{name}.scope.setter': lambda g: _set(getattr(g, attr), 'scope', g.server),
+        f'{name}.scope.deleter': lambda g: _del(getattr(g, attr), 'scope'),
+        f'{name}.is_scope_supported': lambda g: getattr(g, attr).is_scope_supported(g.server),
+    }
+
+
+def _model_cases(name: str, model, attr: str) -> dict:
+    return {
+        f'{name}.label': lambda g: getattr(g, attr).label,
+        f'{name}.get_one': lambda g: model.get_one(getattr(g, attr).id),
+        f'{name}.get_or_create': lambda g: model.get_or_create(name='New'),
+        f'{name}.get_all': lambda g: list(model.get_all()),
+        f'{name}.from_node': lambda g: model.from_node(getattr(g, attr).as_node()),
+        f'{name}.as_node': lambda g: getattr(g, attr).as_node(),
+        f'{name}.create': lambda g: model.create(name='New'),
+        f'{name}.save': lambda g: getattr(g, attr).save(),
+        f'{name}.delete': lambda g: getattr(g, attr).delete(),
+        f'{name}.get_model': lambda g: model.get_model(name),
+    }
+
+
+CASES = {
+    **_model_cases('Entity', User, 'adam'),
+    'Entity.get_groups': lambda g: list(g.adam.get_groups()),
+    'Entity.get_groups(scope)': lambda g: list(g.adam.get_groups(g.server)),
+    'Entity.add_to_group': lambda g: g.ivan.add_to_group(g.editors),
+    'Entity.remove_from_group': lambda g: g.adam.remove_from_group(g.moderators),
+    'Entity.remove_from_all_groups': lambda g: g.adam.remove_from_all_groups(),
+    'Entity.get_all_activated_abilities': lambda g: list(g.adam.get_all_activated_abilities()),
+    'Entity.get_activated_abilities': lambda g: list(g.adam.get_activated_abilities(g.server)),
+    'Entity.activate_ability': lambda g: g.ivan.activate_ability(g.ability, g.fly, scope=g.server),
+    'Entity.reset_ability': lambda g: g.adam.reset_ability(g.ability, scope=g.server),
+    'Entity.reset_ability_in_all_scopes': lambda g: g.adam.reset_ability_in_all_scopes(g.ability),
+    'Entity.reset_all_abilities': lambda g: g.adam.reset_all_abilities(),
+    'Entity.get_linked_perms': lambda g: list(g.adam.get_linked_perms(g.server)),
+    'Entity.get_all_linked_perms': lambda g: list(g.adam.get_all_linked_perms()),
+    'Entity.link_perm': lambda g: g.ivan.link_perm(g.update, allow=False),
+    'Entity.link_perm(scope)': lambda g: g.ivan.link_perm(g.fly, scope=g.server),
+    'Entity.reset_perm': lambda g: g.adam.reset_perm(g.fly, scope=g.server),
+    'Entity.reset_all_perms_in_scope': lambda g: g.adam.reset_all_perms_in_scope(g.server),
+    'Entity.reset_all_perms': lambda g: g.adam.reset_all_perms(),
+    'Entity.get_allowed_perms': lambda g: list(g.adam.get_allowed_perms()),
+    'Entity.get_allowed_perms(scope)': lambda g: list(g.adam.get_allowed_perms(g.server)),
+    'Entity.is_able': lambda g: g.adam.is_able(g.update),
+    'Entity.is_able(scope)': lambda g: g.adam.is_able(g.fly, g.server),
+    'Entity.get_permission_set': lambda g: g.adam.get_permission_set(g.server),
+    'Entity.get_permission_matrix': lambda g: User.get_permission_matrix([g.adam, g.ivan], g.server),
+
+    **_model_cases('Group', Group, 'editors'),
+    **_has_scope_cases('Group', 'moderators'),
+    'Group.inherits': lambda g: g.moderators.inherits,
+    'Group.get_global': lambda g: Group.get_global(),
+    'Group.make_global': lambda g: g.editors.make_global(force=True),
+    'Group.make_optional': lambda g: g.users.make_optional(),
+    'Group.get_linked_perms': lambda g: list(g.editors.get_linked_perms()),
+    'Group.link_perm': lambda g: g.editors.link_perm(g.select, allow=False),
+    'Group.link_all_perms': lambda g: g.editors.link_all_perms(),
+    'Group.reset_perm': lambda g: g.editors.reset_perm(g.update),
+    'Group.reset_all_perms': lambda g: g.editors.reset_all_perms(),
+    'Group.get_allowed_perms': lambda g: list(g.moderators.get_allowed_perms(g.server)),
+    'Group.is_able': lambda g: g.moderators.is_able(g.update, g.server),
+    'Group.get_permission_set': lambda g: g.moderators.get_permission_set(g.server),
+
+    **_model_cases('Scope', Scope, 'server'),
+    'Scope.subset_of': lambda g: g.server.subset_of,
+    'Scope.get_linked_perms': lambda g: list(g.modpack.get_linked_perms()),
+    'Scope.link_perm': lambda g: g.server.link_perm(g.select),
+    'Scope.reset_perm': lambda g: g.modpack.reset_perm(g.fly),
+    'Scope.reset_all_perms': lambda g: g.modpack.reset_all_perms(),
+
+    **_model_cases('Perm', Perm, 'fly'),
+    **_has_scope_cases('Perm', 'fly'),
+    'Perm.get_index': lambda g: Perm.get_index(),
+
+    **_model_cases('Ability', Ability, 'ability'),
+    **_has_scope_cases('Ability', 'ability'),
+    'Ability.get_available_for_scope': lambda g: Ability.get_available_for_scope(g.modpack),
+    'Ability.is_perm_supported': lambda g: g.ability.is_perm_supported(g.fly),
+    'Ability.get_supported_perms': lambda g: list(g.ability.get_supported_perms()),
+    'Ability.add_perm_support': lambda g: g.ability.add_perm_support(g.select),
+    'Ability.remove_perm_support': lambda g: g.ability.remove_perm_support(g.fly),
+    'Ability.remove_all_supported_perms': lambda g: g.ability.remove_all_supported_perms(),
+}
+
+
+@fixture(autouse=True)
+def default_cache():
+    # Budgets are recorded with the decision cache in its default, disabled state
+    ttl, decision_cache.ttl = decision_cache.ttl, 0
+    yield
+    decision_cache.ttl = ttl
+
+
+@fixture(scope='module')
+def budget(request, graph):
+    update = request.config.getoption('--update-query-budget')
+    try:
+        with open(BUDGET_FILE) as fh:
+            data = json.load(fh)
+    except FileNotFoundError:
+        data = {}
+    measured = {}
+    yield SimpleNamespace(update=update, limits=data.get(graph.name), measured=measured)
+    if update and measured:
+        data[graph.name] = {**data.get(graph.name, {}), **measured}
+        data[graph.name] = dict(sorted(data[graph.name].items()))
+        with open(BUDGET_FILE, 'w') as fh:
+            json.dump(data, fh, indent=2)
+            fh.write('\n')
+
+
+def test_every_public_method_has_budget():
+    for model in (Entity, Group, Scope, Perm, Ability):
+        for klass in model.__mro__:
+            if klass in (dict, object):
+                continue
+            for name, value in vars(klass).items():
+                if not name.startswith('_') and not ismemberdescriptor(value):
+                    assert f'{model.__name__}.{name}' in CASES, f'No query budget case for {model.__name__}.{name}'
+
+
+@mark.parametrize('case', list(CASES))
+def test_query_budget(case, budget, graph, clear_db):
+    g = build_reference_graph()
+    with count_queries() as statements:
+        CASES[case](g)
+    if budget.update:
+        budget.measured[case] = len(statements)
+        return
+    assert budget.limits is not None, (
+        f'No query budget recorded for {graph.name}, run pytest --update-query-budget against it')
+    assert case in budget.limits, f'No query budget recorded for {case}, run pytest --update-query-budget'
+    assert len(statements) <= budget.limits[case], (
+            f'{case} sent {len(statements)} queries, budget is {budget.limits[case]}:\n' + '\n'.join(statements))
+
+
+def test_link_perm_checks_scope_in_one_query(assert_max_queries, graph, clear_db):
+    if graph.get_session_bookmark() is not None:
+        skip('Writes also advance the bookmark')
+    g = build_reference_graph()
+    with assert_max_queries(3):
+        g.ivan.link_perm(g.fly, scope=g.server)
@@ -0,0 +1,82 @@
+from pytest import fixture, raises
+
+from cups.backends import Backend, connect
+from cups.backends.routing import RoutingBackend
+from cups.backends.sqlite import SQLiteBackend
+
+
+def replicate(primary: SQLiteBackend, replica: SQLiteBackend):
+    primary.connection.backup(replica.connection)
+
+
+@fixture
+def router(tmp_path) -> RoutingBackend:
+    router = connect(f'sqlite:///{tmp_path}/primary.db', [f'sqlite:///{tmp_path}/replica.db'])
+    yield router
+    for backend in (router.primary, *router.replicas):
+        backend.connection.close()
+
+
+def test_read_your_writes(router):
+    primary, replica = router.primary, router.replicas[0]
+    with router.session() as session:
+        id = router.create_node('User:Entity', {'name': 'Adam'})
+        assert session.bookmark == 1
+        # Replica is behind the session bookmark, so the read goes to primary
+        assert [i['name'] for i in router.match_nodes('Entity', id)] == ['Adam']
+
+    with router.session():
+        assert list(router.match_nodes('Entity', id)) == []
+
+    replicate(primary, replica)
+    primary.update_node('Entity', id, {'name': 'Stale on replica'})
+    with router.session(bookmark=session.bookmark):
+        assert [i['name'] for i in router.match_nodes('Entity', id)] == ['Adam']
+
+
+def test_transaction_pins_primary(router):
+    replicate(router.primary, router.replicas[0])
+    with router.session() as session:
+        with router.transaction():
+            id = router.create_node('Perm', {'name': 'select'})
+            router.primary.update_node('Perm', id, {'name': 'update'})
+            assert [i['name'] for i in router.match_nodes('Perm', id)] == ['update']
+        assert session.bookmark == router.primary.get_bookmark()
+
+
+def test_write_without_bookmark_is_rolled_back(router, monkeypatch):
+    def fail():
+        raise RuntimeError('bookmark unavailable')
+
+    monkeypatch.setattr(router.primary, 'advance_bookmark', fail)
+    with router.session() as session:
+        with raises(RuntimeError):
+            router.create_node('Perm', {'name': 'select'})
+        assert session.bookmark is None
+    assert list(router.primary.match_nodes('Perm')) == []
+
+
+def test_transaction_advances_bookmark_once(router):
+    with router.session() as session:
+        with router.transaction():
+            router.create_node('Perm', {'name': 'select'})
+            router.create_node('Perm', {'name': 'update'})
+        assert session.bookmark == router.primary.get_bookmark() == 1
+
+
+def test_session_and_transaction_without_replicas(tmp_path):
+    for backend in (Backend('test'), connect(f'sqlite:///{tmp_path}/single.db')):
+        with backend.session(bookmark=3) as session:
+            with backend.transaction():
+                pass
+            assert session.bookmark == 3
+
+
+def test_delete_all_keeps_bookmark_growing(router):
+    with router.session() as session:
+        router.create_node('Perm', {'name': 'select'})
+        replicate(router.primary, router.replicas[0])
+        router.delete_all()
+        assert session.bookmark == router.primary.get_bookmark() == 2
+        # Replica still holds the node from before the wipe, so it is not caught up
+        assert list(router.match_nodes('Perm')) == []
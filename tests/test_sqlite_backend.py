@@ -0,0 +1,33 @@
+import threading
+
+from pytest import raises
+
+from cups.backends.sqlite import SQLiteBackend
+
+
+class Interrupted(Exception):
+    pass
+
+
+def test_rollback_keeps_writes_of_other_threads():
+    backend = SQLiteBackend('sqlite://')
+    started, written = threading.Event(), threading.Event()
+    ids = []
+
+    def other():
+        started.wait()
+        ids.append(backend.create_node('Entity', {'name': 'Ivan'}))
+        written.set()
+
+    thread = threading.Thread(target=other)
+    thread.start()
+    with raises(Interrupted):
+        with backend.transaction():
+            backend.create_node('Entity', {'name': 'Adam'})
+            started.set()
+            # Other thread waits for this transaction instead of joining it
+            assert not written.wait(0.2)
+            raise Interrupted
+    thread.join()
+    assert [node['name'] for node in backend.match_nodes('Entity')] == ['Ivan']
+    assert [node.identity for node in backend.match_nodes('Entity')] == ids